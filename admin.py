@@ -1,6 +1,7 @@
 from network import Network
 import argparse
 import os
+import threading
 
 
 ADMIN_KEY = 'kYeVsv1o2qfuBUP508rl'
@@ -13,6 +14,20 @@ def clear_console():
     os.system(command)
 
 
+def print_replies(n):
+    """Thread printing the replies and the watched events sent by the server
+
+    Args:
+        n (Network): admin connection
+    """
+    while True:
+        reply = n.recv()
+        if reply is None:
+            print('Connection lost')
+            break
+        print(reply)
+
+
 def main():
     # argparse
     parser = argparse.ArgumentParser(description='Change parameters for the game')
@@ -26,9 +41,10 @@ def main():
     PORT_NO = args.port_no
     LOBBY_ID = args.lobby_id
 
-    n = Network(SERVER_IP, port_no=PORT_NO, lobby_id=LOBBY_ID, name=ADMIN_KEY)
+    n = Network(SERVER_IP, port_no=PORT_NO, lobby_id=LOBBY_ID, name=ADMIN_KEY, listen=False)
 
     clear_console()
+    threading.Thread(target=print_replies, args=(n,), daemon=True).start()
 
     while True:
         cmd = input()
@@ -0,0 +1,185 @@
+import sqlite3
+import threading
+
+FLUSH_INTERVAL = 0.5    # seconds the saves are gathered for before they are written
+MAX_BATCH = 1000        # pending saves that trigger a write straight away
+
+
+class BankrollStore:
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        """Money of every player by username, kept in SQLite. Saves are gathered in memory and
+        written in batches by a background thread, so the game never waits on the disk. Each
+        batch is one transaction in WAL mode, so a crash loses at most the last unwritten batch
+        and never leaves a partly written one
+
+        Args:
+            path (str): path of the database file
+            flush_interval (float, optional): seconds the saves are gathered for. Defaults to FLUSH_INTERVAL.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.condition = threading.Condition()
+        self.pending = {}       # username -> money saved but not written yet
+        self.releasing = set()  # names released but not written yet
+        self.writing = {}       # batch being written
+        self.saved = 0          # number of saves so far
+        self.written = 0        # number of saves written to the disk
+        self.flush_target = 0   # number of saves a flush is waiting for
+        self.closed = False
+
+        self.reader = self.connect(check_same_thread=False)
+        create_tables(self.reader)
+        self.read_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def connect(self, **kwargs):
+        conn = sqlite3.connect(self.path, timeout=30, **kwargs)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def load(self, name):
+        """Looks up the money of a player, including saves that are not written yet
+
+        Args:
+            name (str): username
+
+        Returns:
+            int: money of the player, None if the player has never been saved
+        """
+        with self.condition:
+            if name in self.pending:
+                return self.pending[name]
+            if name in self.writing:
+                return self.writing[name]
+        with self.read_lock:
+            row = self.reader.execute('SELECT money FROM bankrolls WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def claim(self, name):
+        """Reserves a name for a player taking a seat, so that no two players seated at any table
+        of the server, workers included, share a bankroll
+
+        Args:
+            name (str): username
+
+        Returns:
+            bool: if the name was free
+        """
+        with self.condition:
+            # a name released by this server and claimed again before the release is written
+            if name in self.releasing:
+                self.releasing.discard(name)
+                return True
+        with self.read_lock:
+            with self.reader:
+                claimed = self.reader.execute('INSERT OR IGNORE INTO seated (name) VALUES (?)', (name,)).rowcount
+        return claimed == 1
+
+    def release(self, name):
+        """Frees a name claimed by a player that is no longer seated. Written with the next batch of saves
+
+        Args:
+            name (str): username
+        """
+        with self.condition:
+            self.releasing.add(name)
+            self.condition.notify_all()
+
+    def save(self, name, money):
+        """Queues the money of a player to be written, only the latest save of each player is written
+
+        Args:
+            name (str): username
+            money (int): money of the player
+        """
+        with self.condition:
+            self.pending[name] = money
+            self.saved += 1
+            if len(self.pending) == 1 or len(self.pending) >= MAX_BATCH:
+                self.condition.notify_all()
+
+    def flush(self):
+        """Blocks until every save made before the call is written
+        """
+        with self.condition:
+            target = self.flush_target = self.saved
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: self.written >= target)
+
+    def close(self):
+        """Writes the pending saves and stops the background thread
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.reader.close()
+
+    def run(self):
+        """Background thread writing the saves in batches
+        """
+        conn = self.connect()
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.releasing or self.closed)
+
+                # gather more saves unless there is a full batch, a flush or close
+                if not self.closed and self.flush_target <= self.written and len(self.pending) < MAX_BATCH:
+                    self.condition.wait(self.flush_interval)
+                self.writing, self.pending = self.pending, {}
+                released, self.releasing = self.releasing, set()
+                target = self.saved
+                closed = self.closed
+
+            try:
+                with conn:
+                    conn.executemany('INSERT INTO bankrolls (name, money) VALUES (?, ?) '
+                                     'ON CONFLICT(name) DO UPDATE SET money = excluded.money', self.writing.items())
+                    conn.executemany('DELETE FROM seated WHERE name = ?', ((name,) for name in released))
+            except sqlite3.Error as e:
+                # keep the batch, unless saved again since, and retry on the next write
+                print(f'Bankroll store: {e}')
+                if closed:
+                    break
+                with self.condition:
+                    self.pending = {**self.writing, **self.pending}
+                    self.releasing |= released
+                    target = self.written
+                    self.condition.wait(self.flush_interval)
+
+            with self.condition:
+                self.writing = {}
+                self.written = target
+                self.condition.notify_all()
+                if closed and not self.pending and not self.releasing:
+                    break
+        conn.close()
+
+
+def create_tables(conn):
+    """Creates the tables of the store if they do not exist
+
+    Args:
+        conn (Connection): connection to the database
+    """
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS bankrolls (name TEXT PRIMARY KEY, money INTEGER NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS seated (name TEXT PRIMARY KEY)')
+
+
+def release_seats(path):
+    """Frees the names claimed by a server that did not shut down cleanly. Called once before the
+    server and its workers open the store
+
+    Args:
+        path (str): path of the database file
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        create_tables(conn)
+        with conn:
+            conn.execute('DELETE FROM seated')
+    finally:
+        conn.close()
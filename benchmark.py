@@ -0,0 +1,489 @@
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from bankroll import BankrollStore
+from blackjack import BlackjackTable, Player, Shoe, diff_snapshot, MAX_PLAYERS
+from codec import encode_state, decode_state
+from network import encode_message, MessageReader
+from snapshot import encode_tables, write_snapshot, read_snapshot
+from strategy import HintCache, hand_key
+
+
+def make_table(players=5, seed=0, deal=True):
+    """Creates a table in the middle of the players' turns
+
+    Args:
+        players (int, optional): number of seated players. Defaults to 5.
+        seed (int, optional): seed of the shuffle. Defaults to 0.
+        deal (bool, optional): confirm the bets, which deals the cards. Defaults to True.
+
+    Returns:
+        BlackjackTable: table in scene 2, or in scene 1 with the bets placed if deal is False
+    """
+    random.seed(seed)
+    game = BlackjackTable()
+    for i in range(players):
+        game.join(Player(f'Player {i}'))
+    for key in game.players:
+        game.player_ready(key)
+    for key in game.players:
+        for _ in range(10):
+            game.add_bet(key)
+    if deal:
+        for key in game.players:
+            game.confirm_bet(key)
+    return game
+
+
+def time_per_call(func, repeat=5):
+    """Times a function
+
+    Args:
+        func (function): function without arguments
+        repeat (int, optional): number of timing runs, the fastest is kept. Defaults to 5.
+
+    Returns:
+        float: seconds per call
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def time_per_copy(obj, func, count=1000, repeat=5):
+    """Times a function that changes its argument, on fresh copies of the argument
+
+    Args:
+        obj (object): object to be copied
+        func (function): function taking a copy of obj
+        count (int, optional): number of calls per timing run. Defaults to 1000.
+        repeat (int, optional): number of timing runs, the fastest is kept. Defaults to 5.
+
+    Returns:
+        float: seconds per call
+    """
+    best = None
+    for _ in range(repeat):
+        copies = [copy.deepcopy(obj) for _ in range(count)]
+        start = time.perf_counter()
+        for copied in copies:
+            func(copied)
+        elapsed = (time.perf_counter() - start) / count
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def start_server(*server_args):
+    """Starts server.py on an open port
+
+    Args:
+        server_args (str): extra arguments for server.py
+
+    Returns:
+        tuple: (Popen, server ip, server port)
+    """
+    process = subprocess.Popen([sys.executable, '-u', 'server.py', '-port', *server_args], stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in process.stdout:
+        match = re.search(r'Server IP: (\S+), Server Port: (\d+)', line)
+        if match:
+            break
+    else:
+        raise RuntimeError('Server did not start')
+
+    # keep reading the logs so that the server never blocks on a full pipe
+    threading.Thread(target=process.stdout.read, daemon=True).start()
+    return process, match.group(1), int(match.group(2))
+
+
+async def poll_lobbies(ip, port, lobbies, duration):
+    """Sits one bot in each lobby and has it request the full table as fast as the server answers
+
+    Args:
+        ip (str): server ip
+        port (int): server port
+        lobbies (list): lobby IDs to join
+        duration (float): seconds to measure for
+
+    Returns:
+        int: number of completed round trips
+    """
+    async def connect(lobby_id):
+        reader, writer = await asyncio.open_connection(ip, port)
+        messages = MessageReader()
+        writer.write(encode_message(f'{lobby_id},bot'))
+        await messages.read(reader)     # player id
+        await messages.read(reader)     # full state
+        return reader, writer, messages
+
+    async def bot(reader, writer, messages, end):
+        count = 0
+        while time.perf_counter() < end:
+            writer.write(encode_message('get'))
+            if await messages.read(reader) is None:
+                break
+            count += 1
+        writer.close()
+        return count
+
+    connections = await asyncio.gather(*(connect(lobby_id) for lobby_id in lobbies))
+    end = time.perf_counter() + duration
+    counts = await asyncio.gather(*(bot(*connection, end) for connection in connections))
+    return sum(counts)
+
+
+def run_clients(ip, port, lobbies, duration, results):
+    """Entry point of a load generating process
+
+    Args:
+        ip (str): server ip
+        port (int): server port
+        lobbies (list): lobby IDs to join
+        duration (float): seconds to measure for
+        results (Queue): queue the number of round trips is put in
+    """
+    results.put(asyncio.run(poll_lobbies(ip, port, lobbies, duration)))
+
+
+def bench_shard(args):
+    """Measures how the round trips per second scale with the number of server worker processes
+
+    Args:
+        args (Namespace): parsed command line arguments
+    """
+    context = multiprocessing.get_context('spawn')
+    baseline = None
+    print(f'{"workers":>8} {"round trips/s":>14} {"speedup":>8}')
+    for workers in args.workers:
+        process, ip, port = start_server('-multi', '-max_tables', str(args.lobbies), '-workers', str(workers))
+        try:
+            # split the lobbies over the load generating processes
+            results = context.Queue()
+            clients = []
+            for i in range(args.clients):
+                lobbies = [f'bench{j}' for j in range(i, args.lobbies, args.clients)]
+                client = context.Process(target=run_clients, args=(ip, port, lobbies, args.duration, results))
+                client.start()
+                clients.append(client)
+            total = sum(results.get() for _ in clients)
+            for client in clients:
+                client.join()
+        finally:
+            process.kill()
+            process.wait()
+
+        rate = total / args.duration
+        if baseline is None:
+            baseline = rate
+        print(f'{workers:>8} {rate:>14.0f} {rate/baseline:>7.2f}x')
+
+
+def bench_codec(args):
+    """Compares the binary state format with pickling the whole table
+
+    Args:
+        args (Namespace): parsed command line arguments
+    """
+    game = make_table(args.players)
+    full = diff_snapshot(None, game.snapshot())
+
+    # the change after a Hit, one card added to one seat
+    state = game.snapshot()
+    next(iter(game.players.values())).get_cards(game.shoe.draw_card())
+    delta = diff_snapshot(state, game.snapshot())
+
+    rows = [
+        ('pickle table', lambda: pickle.dumps(game), pickle.loads),
+        ('binary full', lambda: encode_state(full), decode_state),
+        ('binary delta', lambda: encode_state(delta), decode_state),
+    ]
+    print(f'{"format":<14} {"bytes":>7} {"encode us":>10} {"decode us":>10}')
+    for name, encode, decode in rows:
+        data = encode()
+        encode_time = time_per_call(encode)
+        decode_time = time_per_call(lambda: decode(data))
+        print(f'{name:<14} {len(data):>7} {encode_time*1e6:>10.2f} {decode_time*1e6:>10.2f}')
+
+
+def micro_engine(players, seed):
+    """Times the game engine and the state serialization
+
+    Args:
+        players (int): number of seated players
+        seed (int): seed of the shuffles
+
+    Returns:
+        list: (name, seconds per call)
+    """
+    game = make_table(players, seed)
+    betting = make_table(players, seed, deal=False)
+    player = next(iter(game.players.values()))
+    random.seed(seed)
+    shoe = Shoe()
+
+    # the change after a Hit, one card added to one seat
+    state = game.snapshot()
+    after_hit = copy.deepcopy(game)
+    next(iter(after_hit.players.values())).get_cards(after_hit.shoe.draw_card())
+    new_state = after_hit.snapshot()
+    full = encode_state(diff_snapshot(None, state))
+    pickled = pickle.dumps(game)
+
+    return [
+        ('get_card_total', time_per_call(player.get_card_total)),
+        ('shuffle_shoe', time_per_call(shoe.shuffle_shoe)),
+        ('deal_cards_init', time_per_copy(betting, BlackjackTable.deal_cards_init)),
+        ('next_turn', time_per_copy(game, BlackjackTable.next_turn)),
+        ('dealers_turn', time_per_copy(game, BlackjackTable.dealers_turn)),
+        ('snapshot', time_per_call(game.snapshot)),
+        ('diff_snapshot', time_per_call(lambda: diff_snapshot(state, new_state))),
+        ('encode_state', time_per_call(lambda: encode_state(diff_snapshot(None, state)))),
+        ('decode_state', time_per_call(lambda: decode_state(full))),
+        ('apply_patch', time_per_copy(BlackjackTable(), lambda replica: replica.apply_patch(decode_state(full)))),
+        ('pickle_dumps', time_per_call(lambda: pickle.dumps(game))),
+        ('pickle_loads', time_per_call(lambda: pickle.loads(pickled))),
+    ]
+
+
+def micro_draw(players, seed):
+    """Times the client drawing the table with the dummy video driver
+
+    Args:
+        players (int): number of seated players
+        seed (int): seed of the shuffle
+
+    Returns:
+        list: (name, seconds per call), empty if pygame is not installed
+    """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    try:
+        import pygame
+        import main as client
+    except ImportError:
+        return []
+
+    # the client draws its replica of the table
+    game = BlackjackTable()
+    game.apply_patch(diff_snapshot(None, make_table(players, seed).snapshot()))
+    surface = pygame.display.set_mode((client.WIDTH, client.HEIGHT))
+    pygame.font.init()
+    buttons = [client.Button('Hit', 165, 530), client.Button('Stand', 455, 530), client.Button('Hint', 600, 530)]
+    renderer = client.Renderer(surface)
+
+    def draw_full():
+        renderer.invalidate()
+        renderer.draw(buttons, 2, 0, game)
+
+    # the first frames load the images and fonts
+    draw_full()
+    rows = [
+        ('draw_full', time_per_call(draw_full)),
+        ('draw_idle', time_per_call(lambda: renderer.draw(buttons, 2, 0, game))),
+    ]
+    pygame.quit()
+    return rows
+
+
+def bench_micro(args):
+    """Runs the microbenchmarks, optionally saving them or comparing them with a saved baseline
+
+    Args:
+        args (Namespace): parsed command line arguments
+
+    Returns:
+        int: 1 if a benchmark got slower than the baseline by more than the threshold, otherwise 0
+    """
+    # the client loads its assets relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results = dict(micro_engine(args.players, args.seed) + micro_draw(args.players, args.seed))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(), 'players': args.players, 'seed': args.seed,
+                       'results': results}, f, indent=2)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    regressed = False
+    print(f'{"benchmark":<16} {"us":>10} {"baseline":>10} {"change":>8}')
+    for name, seconds in results.items():
+        line = f'{name:<16} {seconds*1e6:>10.3f}'
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f' {baseline[name]*1e6:>10.3f} {change:>+8.1%}'
+            if change > args.threshold / 100:
+                line += ' slower'
+                regressed = True
+        print(line)
+    return int(regressed)
+
+
+def bench_bankroll(args):
+    """Measures what saving the bankrolls costs the tables and how fast the store writes them
+
+    Every round, all the seats of every table are settled at once, as if that many table executors
+    saved at the same time, then the store is flushed
+
+    Args:
+        args (Namespace): parsed command line arguments
+    """
+    rng = random.Random(args.seed)
+    names = [f'table{t}-seat{s}' for t in range(args.tables) for s in range(MAX_PLAYERS)]
+    blocked = 0.0   # time spent in save, the only part on the path of the tables
+    flushing = 0.0  # time spent writing the saves to the disk
+    with tempfile.TemporaryDirectory() as directory:
+        store = BankrollStore(os.path.join(directory, 'bankroll.db'))
+        for _ in range(args.rounds):
+            results = [(name, rng.randint(0, 200)) for name in names]
+            start = time.perf_counter()
+            for name, money in results:
+                store.save(name, money)
+            saved = time.perf_counter()
+            store.flush()
+            blocked += saved - start
+            flushing += time.perf_counter() - saved
+        store.close()
+
+    saves = len(names) * args.rounds
+    print(f'{args.tables} tables, {len(names)} players, {args.rounds} rounds')
+    print(f'save:       {blocked / saves * 1e6:.2f} us per call')
+    print(f'Throughput: {saves / flushing:.0f} saves written per s')
+
+
+def bench_snapshot(args):
+    """Measures how long saving and restoring the snapshot of many tables in the middle of a round takes
+
+    Args:
+        args (Namespace): parsed command line arguments
+    """
+    tables = []
+    for i in range(args.tables):
+        with contextlib.redirect_stdout(io.StringIO()):
+            game = make_table(args.players, seed=i)
+        tables.append((f'bench{i}', game, {int(key): os.urandom(16).hex() for key in game.players}))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tables.snap')
+        data = encode_tables(tables)
+        encode_time = time_per_call(lambda: encode_tables(tables), repeat=3)
+        write_time = time_per_call(lambda: write_snapshot(path, data), repeat=3)
+        read_time = time_per_call(lambda: read_snapshot(path), repeat=3)
+
+    print(f'{args.tables} tables of {args.players} players, {len(data)} bytes')
+    print(f'Encode:   {encode_time*1e3:.2f} ms')
+    print(f'Write:    {write_time*1e3:.2f} ms (with fsync)')
+    print(f'Restore:  {read_time*1e3:.2f} ms')
+
+
+def bench_hints(args):
+    """Measures how long the hints take to work out and to look up once cached, on tables dealt
+    from shoes that are partly used up
+
+    Args:
+        args (Namespace): parsed command line arguments
+    """
+    hints = HintCache()
+    start = time.perf_counter()
+    precomputed = hints.precompute()
+    precompute_time = time.perf_counter() - start
+
+    rng = random.Random(args.seed)
+    keys = []
+    for i in range(args.tables):
+        with contextlib.redirect_stdout(io.StringIO()):
+            game = make_table(args.players, seed=args.seed + i, deal=False)
+            # the cards dealt in earlier rounds of the shoe
+            game.shoe.remaining -= rng.randrange(game.shoe.remaining - game.shoe.cut)
+            for key in game.players:
+                game.confirm_bet(key)
+        keys += [hand_key(game, key) for key in game.players if hand_key(game, key) is not None]
+    key_time = time_per_call(lambda: hand_key(game, next(iter(game.players))))
+
+    # every hand is asked about twice, the second time is a cache hit
+    computed = []
+    for key in keys:
+        if hints.get(key) is None:
+            start = time.perf_counter()
+            hints.compute(key)
+            computed.append(time.perf_counter() - start)
+        hints.get(key)
+    computed.sort()
+    stats = hints.stats()
+    lookup_time = time_per_call(lambda: hints.get(keys[0]))
+
+    print(f'{args.tables} tables of {args.players} players, {len(keys)} hands with a choice to make')
+    print(f'Precompute: {precomputed} hints in {precompute_time:.2f} s')
+    print(f'Situation:  {key_time*1e6:.2f} us (hand_key)')
+    print(f'Cached:     {lookup_time*1e6:.2f} us per lookup')
+    if computed:
+        print(f'Worked out: {len(computed)} hints, mean {sum(computed) / len(computed) * 1e3:.2f} ms, '
+              f'p50 {computed[len(computed) // 2] * 1e3:.2f} ms, max {computed[-1] * 1e3:.2f} ms')
+    print(f'Cache:      {stats}')
+
+
+def main():
+    # argparse
+    parser = argparse.ArgumentParser(description='Benchmarks for the server and the game engine')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    shard = subparsers.add_parser('shard', help='Throughput of the server against the number of worker processes')
+    shard.add_argument('-workers', '--workers', metavar='', type=int, nargs='+', default=[0, 1, 2, 4], help='Worker process counts to compare')
+    shard.add_argument('-clients', '--clients', metavar='', type=int, default=os.cpu_count(), help='Number of load generating processes')
+    shard.add_argument('-lobbies', '--lobbies', metavar='', type=int, default=64, help='Number of tables, each with one bot')
+    shard.add_argument('-duration', '--duration', metavar='', type=float, default=5, help='Seconds to measure for each worker count')
+    shard.set_defaults(run=bench_shard)
+
+    codec = subparsers.add_parser('codec', help='Size and speed of the binary state format against pickle')
+    codec.add_argument('-players', '--players', metavar='', type=int, default=5, help='Number of seated players')
+    codec.set_defaults(run=bench_codec)
+
+    micro = subparsers.add_parser('micro', help='Speed of the game engine, the state serialization and the client drawing')
+    micro.add_argument('-players', '--players', metavar='', type=int, default=5, help='Number of seated players')
+    micro.add_argument('-seed', '--seed', metavar='', type=int, default=0, help='Seed of the shuffles')
+    micro.add_argument('-json', '--json', metavar='', type=str, help='Save the results to this JSON file')
+    micro.add_argument('-baseline', '--baseline', metavar='', type=str, help='Compare with the results saved in this JSON file')
+    micro.add_argument('-threshold', '--threshold', metavar='', type=float, default=10, help='Percentage slower than the baseline that counts as a regression')
+    micro.set_defaults(run=bench_micro)
+
+    bankroll = subparsers.add_parser('bankroll', help='Cost of saving the bankrolls and write throughput of the store')
+    bankroll.add_argument('-tables', '--tables', metavar='', type=int, default=1000, help='Number of tables settling at once')
+    bankroll.add_argument('-rounds', '--rounds', metavar='', type=int, default=20, help='Number of rounds settled at every table')
+    bankroll.add_argument('-seed', '--seed', metavar='', type=int, default=0, help='Seed of the results')
+    bankroll.set_defaults(run=bench_bankroll)
+
+    snapshot = subparsers.add_parser('snapshot', help='Time taken to save and restore the snapshot of many tables')
+    snapshot.add_argument('-tables', '--tables', metavar='', type=int, default=500, help='Number of tables')
+    snapshot.add_argument('-players', '--players', metavar='', type=int, default=5, help='Number of seated players at each table')
+    snapshot.set_defaults(run=bench_snapshot)
+
+    hints = subparsers.add_parser('hints', help='Time taken to work out the hints and to look them up once cached')
+    hints.add_argument('-tables', '--tables', metavar='', type=int, default=50, help='Number of tables dealt')
+    hints.add_argument('-players', '--players', metavar='', type=int, default=5, help='Number of seated players at each table')
+    hints.add_argument('-seed', '--seed', metavar='', type=int, default=0, help='Seed of the shuffles')
+    hints.set_defaults(run=bench_hints)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,51 @@
 import random
-import time
+from array import array
+from history import LEAVE, BET, DEAL, HIT, STAND, DRAW, SETTLE, MONEY, ABORT, CLEAR, DEALER
 
 # const
 MAX_PLAYERS = 5
 DEFAULT_MONEY = 100
+DEFAULT_DECKS = 6
+DEFAULT_PENETRATION = 0.75          # share of the shoe dealt before the cut card comes out
+SUITS = ['diamond', 'club', 'heart', 'spade']
+RANKS = ['ace', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'jack', 'queen', 'king']
+DECK_SIZE = 52
+HIDDEN_CARD = 52                    # card code sent in place of a face down card
+
+# Cards are small integers, suit*13 + rank-1, and everything about a card is looked up by its code
+CARD_VALUES = [min(code % 13 + 1, 10) for code in range(DECK_SIZE)] + [0]       # blackjack value, aces are 1
+CARD_NAMES = [f'{rank}_of_{suit}s' for suit in SUITS for rank in RANKS] + ['red_joker']  # asset names
+EMPTY_SNAPSHOT = {'scene': None, 'turn': None, 'order': (), 'dealer': (), 'seats': {}}
+SEAT_FIELDS = ['name', 'money', 'bet', 'is_ready', 'has_busted', 'has_won']
 
 class BlackjackTable:
-    def __init__(self):
+    def __init__(self, decks=DEFAULT_DECKS, penetration=DEFAULT_PENETRATION, shoe=None):
+        """Blackjack table
+
+        Args:
+            decks (int, optional): number of decks in the shoe. Defaults to DEFAULT_DECKS.
+            penetration (float, optional): share of the shoe dealt before reshuffling. Defaults to DEFAULT_PENETRATION.
+            shoe (Shoe, optional): shoe to deal from, None for a new shoe of decks and penetration. Defaults to None.
+        """
         self.players = {}               # players in the game
-        self.deck = Deck()              # deck of cards
-        self.deck.shuffle_deck()
+        self.shoe = Shoe(decks, penetration) if shoe is None else shoe  # shoe of cards
         self.current_turn_idx = None    # who's turn is it
         self.dealer = Dealer()          # dealer's set of cards
         self.scene = 0                  # current scene
+        self.history = None             # HandHistory the events of the table are logged to, if any
+
+    def record(self, event, seat=0, card=0, extra=0, value=0):
+        """Logs an event to the hand history, if the table keeps one
+
+        Args:
+            event (int): event code from history.py
+            seat (int or str, optional): player ID. Defaults to 0.
+            card (int, optional): card code. Defaults to 0.
+            extra (int, optional): has_won. Defaults to 0.
+            value (int, optional): money or bet. Defaults to 0.
+        """
+        if self.history is not None:
+            self.history.record(event, int(seat), card, extra, value)
 
     def get_id(self):
         """Finds an unassigned ID for new player
@@ -26,7 +59,7 @@ class BlackjackTable:
         return -1
 
     def join(self, player):
-        """Allows a player to join the table
+        """Allows a player to join the table. Players should only join in between rounds
 
         Args:
             player (Player): Player that joined the table
@@ -37,11 +70,28 @@ class BlackjackTable:
         id = self.get_id()
         if id == -1:
             return -1, -1
-        while self.scene != 0:
-            time.sleep(2)
         self.players[str(id)] = player
+        if self.history is not None:
+            self.history.join(id, player.name, player.money)
         return 0, id
 
+    def record_table(self):
+        """Logs the seats, bets and cards of the table to the hand history, so that a table restored
+        from a snapshot carries on from them after the START record
+        """
+        if self.history is None:
+            return
+        for key, player in self.players.items():
+            # the bet is taken out of the money when it is placed, and the BET record takes it out again
+            self.history.join(int(key), player.name, player.money + player.bet)
+            if player.bet and (player.is_ready or self.scene >= 2):
+                self.record(BET, key, value=player.bet)
+        for card in self.dealer.cards:
+            self.record(DEAL, DEALER, card)
+        for key, player in self.players.items():
+            for card in player.cards:
+                self.record(DEAL, key, card)
+
     def disconnect(self, player):
         """Disconnects the player from the game
 
@@ -49,9 +99,25 @@ class BlackjackTable:
             player (int): player ID
         """
         self.does_player_exists(player)
+        seat = list(self.players).index(str(player))
         del self.players[str(player)]
+        self.record(LEAVE, player)
         self.reset_ready()
 
+        # nobody is left to finish the round
+        if not self.players and self.scene != 0:
+            self.new_round()
+            return
+
+        # the turn index counts the seats, so it moves with the players after the one who left
+        if self.scene == 2 and self.current_turn_idx is not None:
+            if seat < self.current_turn_idx:
+                self.current_turn_idx -= 1
+            elif seat == self.current_turn_idx:
+                # the turn goes on to the next player, or to the dealer
+                self.current_turn_idx -= 1
+                self.next_turn()
+
     def is_all_player_ready(self):
         """Check if all the players are ready
 
@@ -116,6 +182,7 @@ class BlackjackTable:
         if player.is_ready or player.bet == 0:
             return
         player.is_ready = True
+        self.record(BET, id, value=player.bet)
 
         # transition
         if self.is_all_player_ready():
@@ -155,18 +222,22 @@ class BlackjackTable:
     def deal_cards_init(self):
         """Give dealer and all players 2 cards
         """
-        self.deck.shuffle_deck()
+        self.shoe.start_round()
 
         # Dealer gets 2 cards and see if blackjack occured
-        self.dealer.get_cards(self.deck.draw_card())
-        self.dealer.get_cards(self.deck.draw_card())
-        self.dealer.cards[1].hidden = True
+        for _ in range(2):
+            card = self.shoe.draw_card()
+            self.dealer.get_cards(card)
+            self.record(DEAL, DEALER, card)
+        self.dealer.hidden = True
         blackjack_dealer = self.dealer.has_blackjacked()
 
         # each player gets 2 cards
         for key in self.players.keys():
-            self.players[key].get_cards(self.deck.draw_card())
-            self.players[key].get_cards(self.deck.draw_card())
+            for _ in range(2):
+                card = self.shoe.draw_card()
+                self.players[key].get_cards(card)
+                self.record(DEAL, key, card)
             blackjack_player = self.players[key].has_blackjacked()
             
             # if dealer blackjacks
@@ -180,6 +251,7 @@ class BlackjackTable:
                     self.players[key].has_won = 1
                     self.players[key].money += self.players[key].bet
                     self.players[key].bet = 0
+                self.record(SETTLE, key, extra=self.players[key].has_won, value=self.players[key].money)
             # if player blackjacks and dealer doesn'ts
             elif blackjack_player:
                 print(f'{self.players[key].name} has Blackjacked')
@@ -188,7 +260,7 @@ class BlackjackTable:
         if blackjack_dealer:
             print(f'Dealer Blackjacked')
             self.scene = 3
-            self.dealer.cards[1].hidden = False
+            self.dealer.hidden = False
 
     def hit(self, player_id):
         keys = list(self.players.keys())
@@ -205,15 +277,18 @@ class BlackjackTable:
         curr_turn = keys[self.current_turn_idx]
         if str(player_id) != curr_turn:
             return
+        self.record(STAND, player_id)
         self.next_turn()
 
     def dealers_turn(self):
         dealer = self.dealer
-        dealer.cards[1].hidden = False
+        dealer.hidden = False
 
         total_dealer = dealer.get_card_total()
         while total_dealer < 17:
-            dealer.get_cards(self.deck.draw_card())
+            card = self.shoe.draw_card()
+            dealer.get_cards(card)
+            self.record(DRAW, card=card)
             total_dealer = dealer.get_card_total()
 
         # calculate winners
@@ -235,6 +310,7 @@ class BlackjackTable:
                 player.has_won = 2
             
             player.bet = 0
+            self.record(SETTLE, key, extra=player.has_won, value=player.money)
 
     def add_card(self, player_id):
         """Draws a card for a given player
@@ -246,9 +322,11 @@ class BlackjackTable:
             int: 0 if the card is successfully drawn, -1 if the player has already busted
         """
         self.does_player_exists(player_id)
-        if self.players[str(player_id)].get_card_total() > 21:
+        if self.players[str(player_id)].cards.is_busted():
             return -1
-        self.players[str(player_id)].get_cards(self.deck.draw_card())
+        card = self.shoe.draw_card()
+        self.players[str(player_id)].get_cards(card)
+        self.record(HIT, player_id, card)
         return 0
 
     def reset(self, player_id):
@@ -257,20 +335,24 @@ class BlackjackTable:
             return
         self.players[str(player_id)].is_ready = True
         if self.is_all_player_ready():
-            self.reset_has_won()
-            self.reset_busted()
-            self.current_turn_idx = None
-            # clear dealers and players hand
-            self.dealer.cards = []
+            self.new_round()
 
-            for key in self.players.keys():
-                self.players[key].cards = []
+    def new_round(self):
+        """Clears the table and goes back to scene 0, where new players can be seated
+        """
+        self.reset_has_won()
+        self.reset_busted()
+        self.current_turn_idx = None
+        self.record(CLEAR)
+        # clear dealers and players hand
+        self.dealer.cards.clear()
+        self.dealer.hidden = False
 
-            # reset deck
-            self.deck.reset_deck()
+        for key in self.players.keys():
+            self.players[key].cards.clear()
 
-            self.scene = 0
-            self.reset_ready()
+        self.scene = 0
+        self.reset_ready()
 
     def does_player_exists(self, player):
         """Check if player exists
@@ -288,10 +370,173 @@ class BlackjackTable:
         try:
             self.does_player_exists(player_id)
             player = self.players[str(player_id)]
+            self.record(MONEY, player_id, value=int(amount) - player.money)
             player.money = int(amount)
         except TypeError:
             return
 
+    def abort_round(self):
+        """Ends the round without settling it, the bets are given back
+        """
+        for key in self.players.keys():
+            self.players[key].money += self.players[key].bet
+            self.players[key].bet = 0
+        self.record(ABORT)
+        self.new_round()
+
+    def snapshot(self):
+        """Captures the state of the table that is visible to the clients
+
+        Returns:
+            dict: scene, turn, seat order, dealer cards and the state of each seat
+        """
+        return {
+            'scene': self.scene,
+            'turn': self.current_turn_idx,
+            'order': tuple(self.players.keys()),
+            'dealer': self.dealer.snapshot(),
+            'seats': {key: player.snapshot() for key, player in self.players.items()},
+        }
+
+    def apply_patch(self, patch):
+        """Updates a client side replica of the table with a patch from diff_snapshot
+
+        Args:
+            patch (dict): fields that changed since the last patch
+        """
+        for key in patch.get('removed', ()):
+            del self.players[key]
+        for key, seat in patch.get('seats', {}).items():
+            if key not in self.players:
+                self.players[key] = Player(seat['name'])
+            self.players[key].apply_patch(seat)
+        if 'order' in patch:
+            self.players = {key: self.players[key] for key in patch['order']}
+
+        if 'scene' in patch:
+            self.scene = patch['scene']
+        if 'turn' in patch:
+            self.current_turn_idx = patch['turn']
+        if 'dealer' in patch:
+            self.dealer.cards = Hand(patch['dealer'])
+        for code in patch.get('dealer_add', ()):
+            self.dealer.cards.append(code)
+
+
+def diff_cards(patch, field, old, new):
+    """Adds the change between two tuples of card codes to a patch
+
+    Args:
+        patch (dict): patch to be filled
+        field (str): name of the field in the snapshot
+        old (tuple): card codes last seen
+        new (tuple): current card codes
+    """
+    if new == old:
+        return
+    if len(new) > len(old) and new[:len(old)] == old:
+        patch[f'{field}_add'] = new[len(old):]
+    else:
+        patch[field] = new
+
+
+def diff_snapshot(old, new):
+    """Computes the patch that turns one snapshot into another
+
+    Args:
+        old (dict): snapshot last seen by the client, None if the client has not seen any
+        new (dict): current snapshot
+
+    Returns:
+        dict: only the fields that changed, empty if nothing has changed
+    """
+    if old is None:
+        old = EMPTY_SNAPSHOT
+    patch = {}
+    for field in ('scene', 'turn', 'order'):
+        if new[field] != old[field]:
+            patch[field] = new[field]
+    diff_cards(patch, 'dealer', old['dealer'], new['dealer'])
+
+    # new seats are sent in full, existing seats only send what changed
+    seats = {}
+    for key, seat in new['seats'].items():
+        old_seat = old['seats'].get(key)
+        if old_seat is None:
+            seats[key] = seat
+            continue
+        seat_patch = {}
+        for field in SEAT_FIELDS:
+            if seat[field] != old_seat[field]:
+                seat_patch[field] = seat[field]
+        diff_cards(seat_patch, 'cards', old_seat['cards'], seat['cards'])
+        if seat_patch:
+            seats[key] = seat_patch
+    if seats:
+        patch['seats'] = seats
+
+    removed = [key for key in old['seats'] if key not in new['seats']]
+    if removed:
+        patch['removed'] = removed
+    return patch
+
+
+
+class Hand:
+    def __init__(self, cards=()):
+        """Cards held by a player or the dealer. The total is kept up to date as cards are added
+        so that it never has to rescan the hand
+
+        Args:
+            cards (iterable, optional): card codes to start with. Defaults to no cards.
+        """
+        self.cards = array('B')
+        self.hard_total = 0     # total counting every ace as 1
+        self.aces = 0           # number of aces in the hand
+        for card in cards:
+            self.append(card)
+
+    def append(self, card):
+        """Adds a card to the hand
+
+        Args:
+            card (int): code of the card to be added
+        """
+        self.cards.append(card)
+        value = CARD_VALUES[card]
+        self.hard_total += value
+        if value == 1:
+            self.aces += 1
+
+    def clear(self):
+        del self.cards[:]
+        self.hard_total = 0
+        self.aces = 0
+
+    def total(self):
+        """Total of the hand, an ace counts as 11 if that does not bust the hand. Only one ace can
+        ever count as 11 since two would make 22
+
+        Returns:
+            int: total of the hand or None if the hand is empty
+        """
+        if not self.cards:
+            return
+        if self.aces and self.hard_total <= 11:
+            return self.hard_total + 10
+        return self.hard_total
+
+    def is_busted(self):
+        return self.hard_total > 21
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __iter__(self):
+        return iter(self.cards)
+
+    def __getitem__(self, idx):
+        return self.cards[idx]
 
 
 class Player:
@@ -306,116 +551,150 @@ class Player:
         self.money = money
         self.bet = 0
         self.is_ready = False
-        self.cards = []
+        self.cards = Hand()
         self.has_busted = False 
         self.has_won = None     # 0 --> lost, 1 --> tie, 2 --> won
 
     def check_busted(self):
-        total = self.get_card_total()
-        if total > 21:
+        if self.cards.is_busted():
             self.has_busted = True
     
     def get_card_total(self):
-        if len(self.cards) == 0:
-            return
-        total = 0
-        aces = 0
-        for card in self.cards:
-            if card.value == 1:
-                aces += 1
-            total += min(card.value, 10)
-        while aces != 0:
-            if total+10 > 21:
-                break
-            total += 10
-            aces -= 1
-        return total 
+        return self.cards.total()
     
     def get_cards(self, card):
         """Add Card for the player
 
         Args:
-            card (Card): card to be added to the hand
+            card (int): code of the card to be added to the hand
         """
         self.cards.append(card)
 
     def has_blackjacked(self):
         assert len(self.cards) == 2
-        return self.get_card_total() == 21
+        return self.cards.total() == 21
+
+    def snapshot(self):
+        """Captures the state of the player that is visible to the clients
+
+        Returns:
+            dict: seat fields and the card codes in the hand
+        """
+        seat = {field: getattr(self, field) for field in SEAT_FIELDS}
+        seat['cards'] = tuple(self.cards)
+        return seat
+
+    def apply_patch(self, seat):
+        """Updates a client side replica of the player
+
+        Args:
+            seat (dict): seat fields that changed
+        """
+        for field in SEAT_FIELDS:
+            if field in seat:
+                setattr(self, field, seat[field])
+        if 'cards' in seat:
+            self.cards = Hand(seat['cards'])
+        for code in seat.get('cards_add', ()):
+            self.cards.append(code)
     
 
 class Dealer:
     def __init__(self):
-        self.cards = []
+        self.cards = Hand()
+        self.hidden = False     # if the second card is face down
 
     def get_cards(self, card):
         self.cards.append(card)
     
     def get_card_total(self):
-        if len(self.cards) == 0:
-            return
-        total = 0
-        aces = 0
-        for card in self.cards:
-            if card.value == 1:
-                aces += 1
-            total += min(card.value, 10)
-        while aces != 0:
-            if total+10 > 21:
-                break
-            total += 10
-            aces -= 1
-        return total
+        return self.cards.total()
 
     def has_blackjacked(self):
         assert len(self.cards) == 2
-        return self.get_card_total() == 21
+        return self.cards.total() == 21
 
+    def snapshot(self):
+        """Captures the dealer's cards that are visible to the clients
 
-class Deck:
-    def __init__(self):
-        self.cards_lst = self.gen_cards()
-        self.cards_lst[-3].value = 1
-        self.cards_lst[-4].value = 10
-
-    def reset_deck(self):
-        self.cards_lst = self.gen_cards()
+        Returns:
+            tuple: card codes with HIDDEN_CARD in place of the face down card
+        """
+        cards = tuple(self.cards)
+        if self.hidden:
+            return cards[:1] + (HIDDEN_CARD,) + cards[2:]
+        return cards
 
-    def gen_cards(self):
-        suits = ['diamond', 'club', 'heart', 'spade']
-        return [Card(val, suit) for suit in suits for val in range(1, 14)]
-    
-    def shuffle_deck(self):
-        random.shuffle(self.cards_lst)
 
-    def draw_card(self):
-        assert len(self.cards_lst) != 0, 'Deck is empty'
-        return self.cards_lst.pop()
+class Shoe:
+    def __init__(self, decks=DEFAULT_DECKS, penetration=DEFAULT_PENETRATION):
+        """Shoe of card codes that is only reshuffled once the cut card has come out
 
+        Args:
+            decks (int, optional): number of decks in the shoe. Defaults to DEFAULT_DECKS.
+            penetration (float, optional): share of the shoe dealt before the cut card. Defaults to DEFAULT_PENETRATION.
 
-class Card:
-    def __init__(self, value, suit):
-        """Card Class that's stored in Deck
+        Raises:
+            ValueError: When there is no deck or the penetration is not in (0, 1]
+        """
+        if decks < 1:
+            raise ValueError('The shoe needs at least one deck')
+        if not 0 < penetration <= 1:
+            raise ValueError('The penetration must be in (0, 1]')
+        self.cards = array('B', range(DECK_SIZE)) * decks  # card codes, drawn from the end
+        self.cut = len(self.cards) - max(1, int(len(self.cards) * penetration))   # cards left when the cut card comes out
+        self.remaining = len(self.cards)    # number of cards not drawn yet
+        self.round_start = self.remaining   # remaining at the start of the round, the cards after it are discarded
+        self.shuffle_shoe()
+
+    @classmethod
+    def from_state(cls, cards, cut, remaining, round_start):
+        """Recreates a shoe in the middle of being dealt, without shuffling it
 
         Args:
-            value (int): value of the card
-            suit (str): suit of the card
+            cards (array): card codes in the order they are drawn, from the end
+            cut (int): cards left when the cut card comes out
+            remaining (int): number of cards not drawn yet
+            round_start (int): remaining at the start of the round
+
+        Returns:
+            Shoe: the shoe
         """
-        self.value = value
-        self.suit = suit
-        self.hidden = False
+        shoe = cls.__new__(cls)
+        shoe.cards = cards
+        shoe.cut = cut
+        shoe.remaining = remaining
+        shoe.round_start = round_start
+        return shoe
+
+    def shuffle_shoe(self):
+        """Puts all the cards back and shuffles the shoe in place
+        """
+        self.remaining = len(self.cards)
+        random.shuffle(self.cards)
 
-    def __str__(self):
-        if self.hidden:
-            return 'red_joker'
-        if self.value == 1:
-            val = 'ace'
-        elif self.value == 11:
-            val = 'jack'
-        elif self.value == 12:
-            val = 'queen'
-        elif self.value == 13:
-            val = 'king'
-        else:
-            val = self.value
-        return f'{val}_of_{self.suit}s'
+    def start_round(self):
+        """Clears the cards of the last round, reshuffling if the cut card came out during it
+        """
+        if self.remaining <= self.cut:
+            self.shuffle_shoe()
+        self.round_start = self.remaining
+
+    def draw_card(self):
+        """Draws a card. If the shoe runs out in the middle of a round, the discarded cards are
+        shuffled back in while the cards of this round stay on the table
+
+        Returns:
+            int: card code
+        """
+        if self.remaining == 0:
+            discards = len(self.cards) - self.round_start
+            assert discards != 0, 'Shoe is empty'
+            self.cards[:] = self.cards[self.round_start:] + self.cards[:self.round_start]
+            shuffled = self.cards[:discards]
+            random.shuffle(shuffled)
+            self.cards[:discards] = shuffled
+            self.remaining = discards
+            self.round_start = len(self.cards)
+        self.remaining -= 1
+        return self.cards[self.remaining]
@@ -0,0 +1,206 @@
+import struct
+
+# Binary encoding of the patches made by blackjack.diff_snapshot. A full table is the patch from
+# no state at all, so the same format carries both the full state and the changes.
+#
+#   version     u8
+#   fields      u8 mask of the table fields below that are present, in this order
+#   scene       u8
+#   turn        u8, NO_TURN for None
+#   order       u8 count, then u8 seat per seat
+#   dealer      u8 count, then u8 card code per card
+#   dealer_add  same as dealer
+#   seats       u8 count, then per seat: u8 seat, u8 mask of the seat fields, then the seat fields
+#   removed     u8 count, then u8 seat per seat
+#
+# Seat fields, in this order
+#   name        u8 length, then utf-8 bytes
+#   money       i64
+#   bet         i64
+#   flags       u8, present if is_ready, has_busted or has_won changed
+#   cards       u8 count, then u8 card code per card
+#   cards_add   same as cards
+FORMAT_VERSION = 1
+NO_TURN = 255
+NO_RESULT = 3           # has_won of None
+MAX_NAME = 255          # bytes of a name, its length is sent in a u8
+
+TABLE_FIELDS = ['scene', 'turn', 'order', 'dealer', 'dealer_add', 'seats', 'removed']
+SEAT_FIELDS = ['name', 'money', 'bet', 'is_ready', 'has_busted', 'has_won', 'cards', 'cards_add']
+FLAG_FIELDS = ['is_ready', 'has_busted', 'has_won']
+
+HEADER = struct.Struct('!BB')
+INT64 = struct.Struct('!q')
+
+
+def encode_state(patch):
+    """Encodes a patch from diff_snapshot into the binary format
+
+    Args:
+        patch (dict): fields that changed
+
+    Returns:
+        bytes: encoded patch
+    """
+    mask = 0
+    for bit, field in enumerate(TABLE_FIELDS):
+        if field in patch:
+            mask |= 1 << bit
+    data = bytearray(HEADER.pack(FORMAT_VERSION, mask))
+
+    if 'scene' in patch:
+        data.append(patch['scene'])
+    if 'turn' in patch:
+        data.append(NO_TURN if patch['turn'] is None else patch['turn'])
+    if 'order' in patch:
+        encode_seat_ids(data, patch['order'])
+    if 'dealer' in patch:
+        encode_cards(data, patch['dealer'])
+    if 'dealer_add' in patch:
+        encode_cards(data, patch['dealer_add'])
+    if 'seats' in patch:
+        data.append(len(patch['seats']))
+        for key, seat in patch['seats'].items():
+            data.append(int(key))
+            encode_seat(data, seat)
+    if 'removed' in patch:
+        encode_seat_ids(data, patch['removed'])
+    return bytes(data)
+
+
+def encode_seat_ids(data, keys):
+    data.append(len(keys))
+    data.extend(int(key) for key in keys)
+
+
+def encode_cards(data, cards):
+    data.append(len(cards))
+    data.extend(cards)
+
+
+def encode_name(name):
+    """Encodes a name, cut to MAX_NAME bytes without splitting a character
+
+    Args:
+        name (str): name of the player
+
+    Returns:
+        bytes: utf-8 bytes of the name
+    """
+    return name.encode()[:MAX_NAME].decode(errors='ignore').encode()
+
+
+def encode_seat(data, seat):
+    mask = 0
+    for bit, field in enumerate(SEAT_FIELDS):
+        if field in seat:
+            mask |= 1 << bit
+    data.append(mask)
+
+    if 'name' in seat:
+        name = encode_name(seat['name'])
+        data.append(len(name))
+        data.extend(name)
+    if 'money' in seat:
+        data.extend(INT64.pack(seat['money']))
+    if 'bet' in seat:
+        data.extend(INT64.pack(seat['bet']))
+    if any(field in seat for field in FLAG_FIELDS):
+        has_won = seat.get('has_won')
+        flags = int(bool(seat.get('is_ready'))) | int(bool(seat.get('has_busted'))) << 1
+        flags |= (NO_RESULT if has_won is None else has_won) << 2
+        data.append(flags)
+    if 'cards' in seat:
+        encode_cards(data, seat['cards'])
+    if 'cards_add' in seat:
+        encode_cards(data, seat['cards_add'])
+
+
+def decode_state(data):
+    """Decodes a patch encoded by encode_state
+
+    Args:
+        data (bytes): encoded patch
+
+    Raises:
+        ValueError: When the data is not in a supported version of the format
+
+    Returns:
+        dict: fields that changed, the same as the patch that was encoded
+    """
+    try:
+        version, mask = HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported state format version {version}')
+        data = memoryview(data)
+        pos = HEADER.size
+
+        patch = {}
+        if mask & 1:
+            patch['scene'] = data[pos]
+            pos += 1
+        if mask & 2:
+            patch['turn'] = None if data[pos] == NO_TURN else data[pos]
+            pos += 1
+        if mask & 4:
+            patch['order'], pos = decode_seat_ids(data, pos)
+        if mask & 8:
+            patch['dealer'], pos = decode_cards(data, pos)
+        if mask & 16:
+            patch['dealer_add'], pos = decode_cards(data, pos)
+        if mask & 32:
+            seats = {}
+            count = data[pos]
+            pos += 1
+            for _ in range(count):
+                seats[str(data[pos])], pos = decode_seat(data, pos+1)
+            patch['seats'] = seats
+        if mask & 64:
+            removed, pos = decode_seat_ids(data, pos)
+            patch['removed'] = list(removed)
+        return patch
+    except (IndexError, struct.error) as e:
+        raise ValueError('Truncated state') from e
+
+
+def decode_seat_ids(data, pos):
+    count = data[pos]
+    return tuple(str(key) for key in data[pos+1:pos+1+count]), pos+1+count
+
+
+def decode_cards(data, pos):
+    count = data[pos]
+    if pos+1+count > len(data):
+        raise IndexError
+    return tuple(data[pos+1:pos+1+count]), pos+1+count
+
+
+def decode_seat(data, pos):
+    mask = data[pos]
+    pos += 1
+    seat = {}
+    if mask & 1:
+        size = data[pos]
+        seat['name'] = bytes(data[pos+1:pos+1+size]).decode(errors='replace')
+        pos += 1 + size
+    if mask & 2:
+        (seat['money'],) = INT64.unpack_from(data, pos)
+        pos += INT64.size
+    if mask & 4:
+        (seat['bet'],) = INT64.unpack_from(data, pos)
+        pos += INT64.size
+    if mask & 56:
+        flags = data[pos]
+        pos += 1
+        if mask & 8:
+            seat['is_ready'] = bool(flags & 1)
+        if mask & 16:
+            seat['has_busted'] = bool(flags & 2)
+        if mask & 32:
+            has_won = flags >> 2 & 3
+            seat['has_won'] = None if has_won == NO_RESULT else has_won
+    if mask & 64:
+        seat['cards'], pos = decode_cards(data, pos)
+    if mask & 128:
+        seat['cards_add'], pos = decode_cards(data, pos)
+    return seat, pos
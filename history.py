@@ -0,0 +1,100 @@
+import os
+import struct
+import time
+from urllib.parse import quote
+
+from codec import encode_name
+
+# the log is a header followed by 20 byte records, so a crash can only leave a partial record at the end
+HEADER = struct.Struct('<8sII')     # magic, version, reserved
+MAGIC = b'BJHIST\0\0'
+VERSION = 1
+RECORD = struct.Struct('<BBBBqd')   # event, seat, card, extra, value, unix time
+NAME_CHUNK = RECORD.size - 1        # bytes of the name carried by each NAME record
+BUFFER_SIZE = 1 << 16
+
+# events, with what the fields of their record mean
+JOIN = 0        # seat, extra: length of the name, value: money. The name follows in NAME records
+NAME = 1        # the bytes after the event code are the next part of the name
+LEAVE = 2       # seat
+BET = 3         # seat, value: whole bet confirmed, which replaces a bet confirmed earlier in the round
+DEAL = 4        # seat or DEALER, card: card dealt before the players' turns
+HIT = 5         # seat, card
+STAND = 6       # seat
+DRAW = 7        # card: card drawn by the dealer
+SETTLE = 8      # seat, extra: has_won, value: money after the bet is settled
+MONEY = 9       # seat, value: money given by an admin, negative if taken away
+ABORT = 10      # the round is ended without settling it, the bets are given back
+CLEAR = 11      # the hands are cleared for the next round
+START = 12      # the log is opened by a server, the seats and hands before it are gone. A restored table
+                # follows with the JOIN, BET and DEAL records of its seats
+EVENT_NAMES = ['join', 'name', 'leave', 'bet', 'deal', 'hit', 'stand', 'draw', 'settle', 'money', 'abort', 'clear',
+               'start']
+DEALER = 255    # seat of the dealer in DEAL records
+
+
+def log_path(directory, lobby_id):
+    """Path of the log of a table
+
+    Args:
+        directory (str): directory of the logs
+        lobby_id (str): lobby ID of the table
+
+    Returns:
+        str: path of the log, the lobby ID is quoted so that any ID gives a valid file name
+    """
+    return os.path.join(directory, f'table_{quote(lobby_id, safe="")}.bjh')
+
+
+class HandHistory:
+    def __init__(self, path, buffer_size=BUFFER_SIZE):
+        """Append only log of everything that happens at a table. The records are buffered and
+        only written when the buffer fills up or on flush, so logging never waits on the disk
+
+        Args:
+            path (str): path of the log, created if it does not exist
+            buffer_size (int, optional): bytes buffered before writing. Defaults to BUFFER_SIZE.
+        """
+        self.path = path
+        self.file = open(path, 'ab', buffering=buffer_size)
+        size = self.file.tell()
+        if size < HEADER.size:
+            # new log, or a crash before the header was written
+            self.file.truncate(0)
+            self.file.write(HEADER.pack(MAGIC, VERSION, 0))
+        elif (size - HEADER.size) % RECORD.size:
+            # drop the partial record left by a crash so that the new records stay aligned
+            self.file.truncate(size - (size - HEADER.size) % RECORD.size)
+        # whoever sat at the table before a restart is gone, unless the table is restored
+        self.record(START)
+
+    def record(self, event, seat=0, card=0, extra=0, value=0):
+        """Appends an event
+
+        Args:
+            event (int): event code
+            seat (int, optional): player ID or DEALER. Defaults to 0.
+            card (int, optional): card code. Defaults to 0.
+            extra (int, optional): has_won or the length of the name. Defaults to 0.
+            value (int, optional): money or bet. Defaults to 0.
+        """
+        self.file.write(RECORD.pack(event, seat, card, extra, value, time.time()))
+
+    def join(self, seat, name, money):
+        """Appends a player joining, with their name in as many NAME records as needed
+
+        Args:
+            seat (int): player ID
+            name (str): username, cut to 255 bytes without splitting a character
+            money (int): money of the player
+        """
+        data = encode_name(name)
+        self.record(JOIN, seat, 0, len(data), money)
+        for i in range(0, len(data), NAME_CHUNK):
+            self.file.write(bytes([NAME]) + data[i:i+NAME_CHUNK].ljust(NAME_CHUNK, b'\0'))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,251 @@
+import argparse
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+from benchmark import start_server
+from network import Network, encode_message
+
+COMMANDS = ['Ready', '+', '-', 'Bet', 'Hit', 'Stand', 'Continue']
+ACTION_TIMEOUT = 5      # seconds a bot waits for the effect of a command before counting a timeout
+POLL_INTERVAL = 1 / 60  # the client polls the replica once per frame at 60 FPS
+
+
+class Bot:
+    def __init__(self, ip, port, lobby_id, name, rng):
+        """Headless client that plays like a person clicking through the buttons of main.py
+
+        Args:
+            ip (str): server ip
+            port (int): server port
+            lobby_id (str): lobby ID to join
+            name (str): name of the bot
+            rng (Random): random generator for the bets
+        """
+        self.rng = rng
+        self.latencies = {command: [] for command in COMMANDS}  # seconds from sending to seeing the effect
+        self.timeouts = 0
+        self.sent = 0           # bytes sent
+        self.n = Network(ip, port, lobby_id=lobby_id, name=name)
+        self.player = str(self.n.getP())
+        self.game = self.n.poll(block=True)
+
+    def me(self):
+        return self.game.players[self.player]
+
+    def act(self, command, done):
+        """Sends a command and waits until its effect shows in the replica
+
+        Args:
+            command (str): command to be sent
+            done (function): takes the replica and returns True once the command has taken effect
+        """
+        start = time.perf_counter()
+        self.n.send(command)
+        self.sent += len(encode_message(command))
+        end = start + ACTION_TIMEOUT
+        while self.game is not None and not done(self.game):
+            remaining = end - time.perf_counter()
+            if remaining <= 0:
+                self.timeouts += 1
+                return
+            self.game = self.n.poll(block=True, timeout=remaining)
+        if self.game is not None:
+            self.latencies[command].append(time.perf_counter() - start)
+
+    def step(self):
+        """Takes the action a player would take on the current frame, if any
+
+        Returns:
+            bool: if an action was taken
+        """
+        game = self.game
+        me = self.me()
+        scene = game.scene
+        if scene == 0 and not me.is_ready:
+            self.act('Ready', lambda g: g.scene != 0 or g.players[self.player].is_ready)
+        elif scene == 1 and not me.is_ready:
+            # raise the bet a few times and sometimes take one back before confirming
+            for _ in range(self.rng.randint(1, 3)):
+                if self.me().money == 0:
+                    break
+                bet = self.me().bet
+                self.act('+', lambda g: g.scene != 1 or g.players[self.player].bet > bet)
+                if self.game is None:
+                    return True
+            if self.me().bet > 1 and self.rng.random() < 0.3:
+                bet = self.me().bet
+                self.act('-', lambda g: g.scene != 1 or g.players[self.player].bet < bet)
+                if self.game is None:
+                    return True
+            if self.me().bet > 0:
+                self.act('Bet', lambda g: g.scene != 1 or g.players[self.player].is_ready)
+        elif scene == 2 and list(game.players).index(self.player) == game.current_turn_idx:
+            # hit until 17 like the dealer
+            if not me.has_busted and me.get_card_total() < 17:
+                cards = len(me.cards)
+                self.act('Hit', lambda g: g.scene != 2 or len(g.players[self.player].cards) > cards)
+            else:
+                turn = game.current_turn_idx
+                self.act('Stand', lambda g: g.scene != 2 or g.current_turn_idx != turn)
+        elif scene == 3 and not me.is_ready:
+            self.act('Continue', lambda g: g.scene != 3 or g.players[self.player].is_ready)
+        else:
+            return False
+        return True
+
+    def play(self, end):
+        """Plays until the end time or until the connection is lost
+
+        Args:
+            end (float): perf_counter time to stop at
+        """
+        while self.game is not None and time.perf_counter() < end:
+            # a bot that ran out of money cannot bet, so the table would wait for it forever
+            if self.game.scene == 1 and self.me().money == 0 and self.me().bet == 0:
+                break
+            if not self.step():
+                time.sleep(POLL_INTERVAL)
+                self.game = self.n.poll()
+        self.n.close()
+
+
+def run_bots(ip, port, lobbies, duration, seed, results):
+    """Entry point of a load generating process, runs one thread per bot
+
+    Args:
+        ip (str): server ip
+        port (int): server port
+        lobbies (list): lobby ID of each bot
+        duration (float): seconds to play for
+        seed (int): seed of the bets
+        results (Queue): queue the measurements are put in
+    """
+    bots = [Bot(ip, port, lobby_id, f'bot{seed}-{i}', random.Random(seed*1000 + i)) for i, lobby_id in enumerate(lobbies)]
+    start = time.perf_counter()
+    end = start + duration
+    threads = [threading.Thread(target=bot.play, args=(end,)) for bot in bots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    results.put({
+        'latencies': {command: [t for bot in bots for t in bot.latencies[command]] for command in COMMANDS},
+        'timeouts': sum(bot.timeouts for bot in bots),
+        'received': sum(bot.n.reader.received for bot in bots),
+        'sent': sum(bot.sent for bot in bots),
+        'elapsed': elapsed,
+    })
+
+
+def process_cpu(pid):
+    """CPU time used by a process and its children, from /proc (Linux only)
+
+    Args:
+        pid (int): process ID
+
+    Returns:
+        float: seconds of CPU time, None if /proc is not available
+    """
+    def stat(pid):
+        with open(f'/proc/{pid}/stat') as f:
+            # the name can contain spaces, the fields after it are split on spaces
+            return f.read().rsplit(')', 1)[1].split()
+
+    try:
+        ticks = os.sysconf('SC_CLK_TCK')
+        pids = [pid]
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    if int(stat(entry)[1]) == pid:
+                        pids.append(int(entry))
+                except (OSError, IndexError):
+                    continue
+        total = 0
+        for p in pids:
+            fields = stat(p)
+            total += int(fields[11]) + int(fields[12])     # utime and stime
+        return total / ticks
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def percentile(values, q):
+    """Nearest rank percentile
+
+    Args:
+        values (list): sorted values
+        q (float): percentile between 0 and 100
+
+    Returns:
+        float: the percentile, None if there are no values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def main():
+    # argparse
+    parser = argparse.ArgumentParser(description='Load test of server.py with headless bots on localhost')
+    parser.add_argument('-bots', '--bots', metavar='', type=int, default=50, help='Number of bots')
+    parser.add_argument('-lobbies', '--lobbies', metavar='', type=int, default=10, help='Number of lobbies the bots are spread over')
+    parser.add_argument('-procs', '--procs', metavar='', type=int, default=os.cpu_count(), help='Number of load generating processes')
+    parser.add_argument('-duration', '--duration', metavar='', type=float, default=30, help='Seconds to play for')
+    parser.add_argument('-seed', '--seed', metavar='', type=int, default=0, help='Seed of the bets')
+    parser.add_argument('-server_args', '--server_args', metavar='', type=str, default='', help='Extra arguments for server.py, e.g. "-workers 2"')
+
+    args = parser.parse_args()
+    if args.bots > args.lobbies * 5:
+        parser.error('there are more bots than seats, use more lobbies')
+
+    process, ip, port = start_server('-multi', '-max_tables', str(args.lobbies), *args.server_args.split())
+    try:
+        # bot i sits in lobby i % lobbies, the bots are split over the processes
+        lobbies = [f'load{i % args.lobbies}' for i in range(args.bots)]
+        procs = min(args.procs, args.bots)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        clients = []
+        cpu_start = process_cpu(process.pid)
+        for i in range(procs):
+            client = context.Process(target=run_bots, args=(ip, port, lobbies[i::procs], args.duration, args.seed + i, results))
+            client.start()
+            clients.append(client)
+        measurements = [results.get() for _ in clients]
+        cpu_end = process_cpu(process.pid)
+        for client in clients:
+            client.join()
+    finally:
+        process.kill()
+        process.wait()
+
+    elapsed = max(m['elapsed'] for m in measurements)
+    print(f'{args.bots} bots in {args.lobbies} lobbies for {elapsed:.1f} s')
+    print(f'{"command":<10} {"count":>8} {"per s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    everything = []
+    for command in COMMANDS + ['all']:
+        if command == 'all':
+            latencies = sorted(everything)
+        else:
+            latencies = sorted(t for m in measurements for t in m['latencies'][command])
+            everything += latencies
+        if not latencies:
+            continue
+        p50, p95, p99 = (percentile(latencies, q) * 1e3 for q in (50, 95, 99))
+        print(f'{command:<10} {len(latencies):>8} {len(latencies)/elapsed:>8.1f} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}')
+    print(f'Timeouts:    {sum(m["timeouts"] for m in measurements)}')
+    print(f'Received:    {sum(m["received"] for m in measurements)/elapsed/1024:.1f} KiB/s')
+    print(f'Sent:        {sum(m["sent"] for m in measurements)/elapsed/1024:.1f} KiB/s')
+    if cpu_start is None or cpu_end is None:
+        print('Server CPU:  not available')
+    else:
+        print(f'Server CPU:  {(cpu_end - cpu_start)/elapsed:.1%} of one core')
+
+
+if __name__ == '__main__':
+    main()
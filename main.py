@@ -1,15 +1,32 @@
 import pygame
 from network import Network
+from blackjack import CARD_NAMES
+from collections import OrderedDict
 import argparse
 
 WIDTH = 745
 HEIGHT = 600
+CARD_SIZE = (83, 121)
+FONT_NAME = 'comicsans'
+FONT_SIZE = 25
+HINT_FONT_SIZE = 20
+
+# layout of the table
+BOX_WIDTH = 125
+BOX_HEIGHT = 150
+OFFSET = 20
 
 # colours
 RED = (255, 0, 0)
 WHITE = (255, 255, 255)
 GREEN = (0, 255, 0)
 
+# regions of the window that are redrawn separately
+STATUS_RECT = pygame.Rect(0, 0, BOX_WIDTH*2 + OFFSET*2 + OFFSET//2, 225)
+DEALER_RECT = pygame.Rect(STATUS_RECT.right, 0, WIDTH - STATUS_RECT.right, 225)
+SEAT_RECTS = [pygame.Rect(OFFSET//2 + (OFFSET+BOX_WIDTH)*i, 225, OFFSET+BOX_WIDTH, 305) for i in range(5)]
+BUTTON_RECT = pygame.Rect(0, 530, WIDTH, HEIGHT-530)
+
 
 class Button:
     def __init__(self, text, x, y, width=120, height=50, colour=(255, 0, 0), text_colour=(255, 255, 255), font_size=30):
@@ -34,15 +51,15 @@ class Button:
         self.text_colour = text_colour
         self.font_size = font_size
 
-    def draw(self, surface):
+    def draw(self, surface, text_cache):
         """Draw the button of the screen
 
         Args:
             surface (pygame.surface): surface to be drawn
+            text_cache (TextCache): cache of the rendered text
         """
         pygame.draw.rect(surface, self.colour, (self.x, self.y, self.width, self.height))
-        font = pygame.font.SysFont('comicsans', self.font_size)
-        text = font.render(self.text, 1, self.text_colour)
+        text = text_cache.render(self.text, self.font_size, self.text_colour)
         x_center = self.x + round(self.width/2) - round(text.get_width()/2)
         y_center = self.y + round(self.height/2) - round(text.get_height()/2)
         surface.blit(text, (x_center, y_center))
@@ -69,6 +86,88 @@ class Button:
         return self.text
 
 
+class TextCache:
+    def __init__(self, max_texts=256):
+        """Cache of the fonts and of the rendered text so that unchanged text is only rendered once
+
+        Args:
+            max_texts (int, optional): number of rendered texts kept, the least recently used is evicted. Defaults to 256.
+        """
+        self.max_texts = max_texts
+        self.fonts = {}             # size -> font
+        self.texts = OrderedDict()  # (text, size, colour) -> rendered text, least recently used first
+
+    def font(self, size):
+        """Returns the font of a given size, looking it up on first use
+
+        Args:
+            size (int): size of the font
+
+        Returns:
+            Font: the font
+        """
+        font = self.fonts.get(size)
+        if font is None:
+            font = self.fonts[size] = pygame.font.SysFont(FONT_NAME, size)
+        return font
+
+    def render(self, text, size, colour=WHITE):
+        """Returns the rendered text, rendering it on first use
+
+        Args:
+            text (str): text to be rendered
+            size (int): size of the font
+            colour (tuple, optional): colour of the text. Defaults to WHITE.
+
+        Returns:
+            Surface: rendered text
+        """
+        key = (text, size, colour)
+        surface = self.texts.get(key)
+        if surface is None:
+            surface = self.texts[key] = self.font(size).render(text, True, colour)
+            if len(self.texts) > self.max_texts:
+                self.texts.popitem(last=False)
+        else:
+            self.texts.move_to_end(key)
+        return surface
+
+
+class CardTextures:
+    def __init__(self, max_sizes=2):
+        """Cache of the card images so that each one is only loaded and scaled once per size
+
+        Args:
+            max_sizes (int, optional): number of sizes kept, the least recently used size is evicted. Defaults to 2.
+        """
+        self.max_sizes = max_sizes
+        self.sizes = OrderedDict()  # size -> image of each card code, least recently used size first
+
+    def get(self, card, size=CARD_SIZE):
+        """Returns the image of a card, loading it on first use
+
+        Args:
+            card (int): code of the card to be drawn, HIDDEN_CARD uses the red_joker back
+            size (tuple, optional): width and height of the image. Defaults to CARD_SIZE.
+
+        Returns:
+            Surface: image in the display's pixel format
+        """
+        images = self.sizes.get(size)
+        if images is None:
+            if len(self.sizes) >= self.max_sizes:
+                self.sizes.popitem(last=False)
+            images = self.sizes[size] = [None] * len(CARD_NAMES)
+        else:
+            self.sizes.move_to_end(size)
+
+        image = images[card]
+        if image is None:
+            image = pygame.image.load(f'asset/cards/{CARD_NAMES[card]}.png').convert_alpha()
+            image = images[card] = pygame.transform.smoothscale(image, size)
+        return image
+
+
 def preprocessing(btns_array, game, player):
     """Extract the necessary information from BlackjackTable to display the game
 
@@ -106,6 +205,12 @@ def preprocessing(btns_array, game, player):
                 btns[0].colour = RED
             else:
                 btns[0].colour = GREEN
+
+        # hints are only given while there is a choice to make
+        if game.players[str(player)].get_card_total() < 21:
+            btns[2].colour = GREEN
+        else:
+            btns[2].colour = RED
             
     return btns, scene
 
@@ -122,9 +227,15 @@ def display_error(err_code):
         err_msg = 'Invalid Lobby ID provided'
     elif err_code == -2:
         err_msg = 'Lobby is too full'
+    elif err_code == -3:
+        err_msg = 'Too many players are waiting'
+    elif err_code == -5:
+        err_msg = 'Name is already seated'
     else:
         err_msg = 'Unknown'
 
+    text_cache = TextCache()
+
     running = True
     while running:
         clock.tick(60)
@@ -136,127 +247,179 @@ def display_error(err_code):
         # draw on screen
         surface.fill((0, 0, 0))
 
-        font = pygame.font.SysFont('comicsans', 25)
-        text = font.render(err_msg, True, WHITE)
+        text = text_cache.render(err_msg, 25)
         text_rect = text.get_rect(center=(WIDTH/2, HEIGHT/2))
         surface.blit(text, text_rect)
         pygame.display.update()
 
 
-def draw(surface, buttons, scene, player, game):
-    """Draw the game
+class Renderer:
+    def __init__(self, surface):
+        """Draws the game, only redrawing the parts of the window whose content has changed
 
-    Args:
-        surface (Surface): window
-        buttons (list): list of buttons that needs to be rendered
-        scene (int): scene that needs to be rendered
-        player (int): current player
-        game (BlackjackTable): game returned from the server
-    """
-    surface.fill((0, 0, 0))
-
-    # var
-    font = pygame.font.SysFont('comicsans', 25)
-    box_width = 125
-    box_height = 150
-    offset = 20
-
-    # rectangle for the dealer
-    pygame.draw.rect(surface, RED, ((box_width*2+offset*3), 40, box_width, box_height), width=1)
-
-    # dealer cards
-    cards = game.dealer.cards
-    for j, card in enumerate(cards):
-        card_img = pygame.image.load(f'asset/cards/{card}.png')
-        card_img = pygame.transform.scale(card_img, (83, 121))
-        x = (box_width*2+offset*3) + 20
-        y = 40+17*j
-        surface.blit(card_img, (x, y))
-    
-    # rectangle for the players
-    for i in range(5):
-        pygame.draw.rect(surface, RED, (offset+(offset+box_width)*i, 300, box_width, box_height), width=1)
-
-    for i in range(5):
-        # connected players
-        if str(i) in game.players.keys():
-            player_data = game.players[str(i)]
-            
-            # player name
-            text = font.render(player_data.name, 1, WHITE)
-            x_center = offset+(offset+box_width)*i + round(box_width/2) - round(text.get_width()/2)
-            y_center = 230
-            surface.blit(text, (x_center, y_center))
-
-            # player cash
-            money_str = f'${player_data.money}'
-            text = font.render(money_str, 1, WHITE)
-            x_center = offset+(offset+box_width)*i + round(box_width/2) - round(text.get_width()/2)
-            y_center = 260
-            surface.blit(text, (x_center, y_center))
-
-            # player card
-            cards = player_data.cards
-            for j, card in enumerate(cards):
-                card_img = pygame.image.load(f'asset/cards/{card}.png')
-                card_img = pygame.transform.scale(card_img, (83, 121))
-                x = offset+(offset+box_width)*i+20
-                y = 300+17*j
-                surface.blit(card_img, (x, y))
-
-            # if scene 1, show bets
-            if scene == 1 and player == i:
-                gap_width = 210
-                gap_height = 50
-                bet_str = f'${player_data.bet}'
-                text = font.render(bet_str, 1, WHITE)
-                x_center = 140 + round(gap_width/2) - round(text.get_width()/2)
-                y_center = 530 + round(gap_height/2) - round(text.get_height()/2)
-                surface.blit(text, (x_center, y_center))
-
-            # if scene 2, show card total
-            if scene == 2 and player == i:
-                total = player_data.get_card_total()
-                if total > 21:
-                    total_str = 'Bust'
-                else:
-                    total_str = f'Total: {total}'
-                text = font.render(total_str, 1, WHITE)
-                x_center = 30
-                y_center = 30
-                surface.blit(text, (x_center, y_center))
-                
-
-            # if scene 3, show if player has won or lost
-            if scene == 3 and player == i:
-                status = player_data.has_won
-                if status == 0:
-                    status_str = 'Lose'
-                elif status == 1:
-                    status_str = 'Tie'
-                elif status == 2:
-                    status_str = 'Win'
+        Args:
+            surface (Surface): window
+        """
+        self.surface = surface
+        self.textures = CardTextures()
+        self.text_cache = TextCache()
+        self.drawn = {}     # region -> content drawn in it
+
+    def invalidate(self):
+        """Redraws the whole window on the next draw
+        """
+        self.drawn = {}
+
+    def draw(self, buttons, scene, player, game, hint=None):
+        """Draw the game
+
+        Args:
+            buttons (list): list of buttons that needs to be rendered
+            scene (int): scene that needs to be rendered
+            player (int): current player
+            game (BlackjackTable): game returned from the server
+            hint (tuple, optional): last hint received from the server. Defaults to None.
+
+        Returns:
+            list: rects of the window that were redrawn
+        """
+        # each region is (name, rect, content, function drawing the content)
+        regions = [
+            ('status', STATUS_RECT, self.status_text(scene, player, game, hint), self.draw_status),
+            ('dealer', DEALER_RECT, tuple(game.dealer.cards), self.draw_dealer),
+        ]
+        for i, rect in enumerate(SEAT_RECTS):
+            player_data = game.players.get(str(i))
+            if player_data is None:
+                content = (i, None)
+            else:
+                content = (i, player_data.name, player_data.money, tuple(player_data.cards))
+            regions.append((f'seat {i}', rect, content, self.draw_seat))
+        bet_str = None
+        if scene == 1 and str(player) in game.players:
+            bet_str = f'${game.players[str(player)].bet}'
+        content = (tuple((btn, btn.text, btn.colour) for btn in buttons), bet_str)
+        regions.append(('buttons', BUTTON_RECT, content, self.draw_buttons))
+
+        # only redraw the regions whose content is not the one already on screen
+        dirty = []
+        for name, rect, content, draw_region in regions:
+            if self.drawn.get(name) == content:
+                continue
+            self.surface.set_clip(rect)
+            self.surface.fill((0, 0, 0), rect)
+            draw_region(content)
+            self.drawn[name] = content
+            dirty.append(rect)
+        self.surface.set_clip(None)
+
+        if dirty:
+            pygame.display.update(dirty)
+        return dirty
+
+    def status_text(self, scene, player, game, hint=None):
+        """Text shown at the top left of the window
+
+        Args:
+            scene (int): scene that needs to be rendered
+            player (int): current player
+            game (BlackjackTable): game returned from the server
+            hint (tuple, optional): (cards in the hand, EV of standing, EV of hitting) from the server. Defaults to None.
+
+        Returns:
+            tuple: (text, font size, hint text or None), or None if nothing is shown
+        """
+        player_data = game.players.get(str(player))
+        if player_data is None:
+            return None
+
+        # if scene 2, show card total
+        if scene == 2:
+            total = player_data.get_card_total()
+            if total > 21:
+                return 'Bust', FONT_SIZE, None
+
+            # a hint is shown until the player draws another card
+            hint_str = None
+            if hint is not None and hint[0] == len(player_data.cards):
+                _, stand, hit = hint
+                if hit > stand:
+                    hint_str = f'Hit: EV {hit:+.3f} (stand {stand:+.3f})'
                 else:
-                    status_str = 'Error'
+                    hint_str = f'Stand: EV {stand:+.3f} (hit {hit:+.3f})'
+            return f'Total: {total}', FONT_SIZE, hint_str
+
+        # if scene 3, show if player has won or lost
+        if scene == 3:
+            status = player_data.has_won
+            if status == 0:
+                status_str = 'Lose'
+            elif status == 1:
+                status_str = 'Tie'
+            elif status == 2:
+                status_str = 'Win'
+            else:
+                status_str = 'Error'
+            return status_str, 45, None
+        return None
+
+    def draw_status(self, content):
+        if content is None:
+            return
+        text_str, size, hint_str = content
+        self.surface.blit(self.text_cache.render(text_str, size), (30, 30))
 
-                status_font = pygame.font.SysFont('comicsans', 45)
-                text = status_font.render(status_str, 1, WHITE)
-                x_center = 30
-                y_center = 30
-                surface.blit(text, (x_center, y_center))
+        # the hint goes under the total
+        if hint_str is not None:
+            self.surface.blit(self.text_cache.render(hint_str, HINT_FONT_SIZE), (30, 75))
 
+    def draw_dealer(self, cards):
+        # rectangle for the dealer
+        x = BOX_WIDTH*2 + OFFSET*3
+        pygame.draw.rect(self.surface, RED, (x, 40, BOX_WIDTH, BOX_HEIGHT), width=1)
+
+        # dealer cards
+        for j, card in enumerate(cards):
+            self.surface.blit(self.textures.get(card), (x+20, 40+17*j))
+
+    def draw_seat(self, content):
+        i = content[0]
+        x = OFFSET + (OFFSET+BOX_WIDTH)*i
+
+        # rectangle for the player
+        pygame.draw.rect(self.surface, RED, (x, 300, BOX_WIDTH, BOX_HEIGHT), width=1)
 
         # waiting for players
-        else:
-            text = font.render('Waiting...', 1, WHITE)
-            x_center = offset+(offset+box_width)*i + round(box_width/2) - round(text.get_width()/2)
-            y_center = 230
-            surface.blit(text, (x_center, y_center))
-    
-    # buttons
-    for btn in buttons:
-        btn.draw(surface)
-    pygame.display.update()
+        if content[1] is None:
+            text = self.text_cache.render('Waiting...', FONT_SIZE)
+            self.surface.blit(text, (x + round(BOX_WIDTH/2) - round(text.get_width()/2), 230))
+            return
+
+        # player name and cash
+        _, name, money, cards = content
+        for text_str, y in ((name, 230), (f'${money}', 260)):
+            text = self.text_cache.render(text_str, FONT_SIZE)
+            self.surface.blit(text, (x + round(BOX_WIDTH/2) - round(text.get_width()/2), y))
+
+        # player card
+        for j, card in enumerate(cards):
+            self.surface.blit(self.textures.get(card), (x+20, 300+17*j))
+
+    def draw_buttons(self, content):
+        buttons, bet_str = content
+
+        # if scene 1, show bets
+        if bet_str is not None:
+            gap_width = 210
+            gap_height = 50
+            text = self.text_cache.render(bet_str, FONT_SIZE)
+            x_center = 140 + round(gap_width/2) - round(text.get_width()/2)
+            y_center = 530 + round(gap_height/2) - round(text.get_height()/2)
+            self.surface.blit(text, (x_center, y_center))
+
+        # buttons
+        for btn, _, _ in buttons:
+            btn.draw(self.surface, self.text_cache)
 
  
 def main():
@@ -275,7 +438,8 @@ def main():
     USR_NAME = args.usrname
 
     # networking
-    n = Network(SERVER_IP, port_no=PORT_NO, lobby_id=LOBBY_ID, name=USR_NAME)
+    n = Network(SERVER_IP, port_no=PORT_NO, lobby_id=LOBBY_ID, name=USR_NAME,
+                on_queue=lambda position: print(f'Waiting for a seat, position {position} in the queue'))
 
     # get return message from server
     msg = int(n.getP())
@@ -288,11 +452,11 @@ def main():
     player = int(msg)
     print(f'You are: Player {player}')
 
-    # get game state
-    try:
-        game = n.send("get")
-    except:
+    # wait for the full game state pushed by the server
+    game = n.poll(block=True)
+    if game is None:
         print('Error when requesting board config')
+        return
 
     player_name = game.players[str(player)].name
 
@@ -302,11 +466,12 @@ def main():
     pygame.display.set_icon(icon)
     pygame.font.init()
     clock = pygame.time.Clock()
+    renderer = Renderer(surface)
 
     # buttons for the game
     btns0 = [Button('Ready', 600, 530)]
     btns1 = [Button('-', 20, 530), Button('+', 350, 530), Button('Bet', 600, 530)]
-    btns2 = [Button('Hit', 165, 530), Button('Stand', 455, 530)]
+    btns2 = [Button('Hit', 165, 530), Button('Stand', 455, 530), Button('Hint', 600, 530)]
     btns3 = [Button('Continue', 600, 530)]
     btn_array = [btns0, btns1, btns2, btns3]
 
@@ -314,25 +479,36 @@ def main():
     while running:
         clock.tick(60)
 
-        # get game state
-        try:
-            game = n.send("get")
-        except:
-            running = False
-            print('Error when requesting board config')
-            break
+        # apply the changes pushed by the server
+        game = n.poll()
 
-        # extract information
+        # connection lost, the server holds the seat for a while so try to take it back
         if game == None:
-            break
+            print('Connection lost, reconnecting')
+            if n.reconnect():
+                game = n.poll(block=True)
+            if game == None:
+                print('Error when requesting board config')
+                break
+            renderer.invalidate()
         
         btns, scene = preprocessing(btn_array, game, player)
 
+        # hints are about the current hand, forget them once the turns are over
+        if scene != 2:
+            n.hint = None
+
         # process events
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                # free the seat straight away instead of having it held for a reconnect
+                n.send('Leave')
                 running = False
 
+            # the window has to be drawn again after being covered
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                renderer.invalidate()
+
             # send button presses to the server
             if event.type == pygame.MOUSEBUTTONUP:
                 pos = pygame.mouse.get_pos()
@@ -352,7 +528,7 @@ def main():
 
 
         # display
-        draw(surface, btns, scene, player, game)
+        renderer.draw(btns, scene, player, game, n.hint)
         
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+import time
+from collections import deque
+
+# upper bounds of the histogram buckets in seconds, from 1 us doubling up to about 8.4 s
+BUCKETS = [1e-6 * 2**i for i in range(24)]
+RATE_WINDOW = 60        # seconds the recent rates are measured over
+
+
+class Histogram:
+    def __init__(self):
+        """Distribution of durations in buckets that double in size, so that observing is cheap
+        and percentiles are accurate to a factor of 2
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last bucket counts everything above BUCKETS[-1]
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Adds a duration
+
+        Args:
+            seconds (float): duration
+        """
+        bucket = 0
+        while bucket < len(BUCKETS) and seconds > BUCKETS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket the percentile falls in
+
+        Args:
+            q (float): percentile between 0 and 100
+
+        Returns:
+            float: seconds, 0 if nothing was observed
+        """
+        if self.count == 0:
+            return 0.0
+        rank = self.count * q / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[bucket], self.max) if bucket < len(BUCKETS) else self.max
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        """Counters, recent event rates and duration histograms of the server process
+        """
+        self.start = time.monotonic()
+        self.counters = {}      # name -> total
+        self.events = {}        # name -> times of the events in the last RATE_WINDOW seconds
+        self.histograms = {}    # name -> Histogram
+
+    def count(self, name, amount=1):
+        """Adds to a counter
+
+        Args:
+            name (str): counter
+            amount (int, optional): amount added. Defaults to 1.
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def event(self, name):
+        """Counts an event and keeps its time to measure the recent rate
+
+        Args:
+            name (str): counter
+        """
+        self.count(name)
+        now = time.monotonic()
+        events = self.events.setdefault(name, deque())
+        events.append(now)
+        while events[0] < now - RATE_WINDOW:
+            events.popleft()
+
+    def observe(self, name, seconds):
+        """Adds a duration to a histogram
+
+        Args:
+            name (str): histogram
+            seconds (float): duration
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def recent(self, name):
+        """Number of events in the last RATE_WINDOW seconds
+
+        Args:
+            name (str): counter
+
+        Returns:
+            int: number of events
+        """
+        events = self.events.get(name, ())
+        cutoff = time.monotonic() - RATE_WINDOW
+        return sum(1 for t in events if t >= cutoff)
+
+    def report(self, gauges):
+        """Formats the metrics for the admin console
+
+        Args:
+            gauges (dict): current values measured by the caller, e.g. open connections
+
+        Returns:
+            str: one metric per line
+        """
+        uptime = time.monotonic() - self.start
+        lines = [f'Uptime: {uptime:.0f} s']
+        lines += [f'{name}: {value}' for name, value in gauges.items()]
+        rounds = self.counters.get('rounds', 0)
+        lines.append(f'Rounds: {rounds} total, {self.recent("rounds")} in the last minute, '
+                     f'{rounds / uptime * 60:.1f} per minute overall')
+        for name in ('bytes in', 'bytes out'):
+            total = self.counters.get(name, 0)
+            lines.append(f'{name.capitalize()}: {total} ({total / uptime:.0f} per s)')
+
+        lines.append(f'{"timing":<20} {"count":>8} {"mean ms":>9} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+        for name, h in sorted(self.histograms.items()):
+            lines.append(f'{name:<20} {h.count:>8} {h.total / h.count * 1e3:>9.3f} {h.percentile(50) * 1e3:>9.3f} '
+                         f'{h.percentile(99) * 1e3:>9.3f} {h.max * 1e3:>9.3f}')
+        return '\n'.join(lines)
+
+
+# metrics of this process, each worker process has its own
+METRICS = Metrics()
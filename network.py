@@ -1,25 +1,155 @@
 import socket
-import pickle
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from blackjack import BlackjackTable
+from codec import decode_state
+
+# every message is sent as a 4 byte big endian length followed by the payload
+HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1 << 20
+RESUME_PREFIX = 'Resume,'   # sent in place of the name to take back a held seat, followed by the resume token
+HINT_PREFIX = 'Hint,'       # starts the replies to the Hint command, the table updates start with their format version byte instead
+RECONNECT_TIMEOUT = 20      # seconds a client keeps trying to resume its seat
+RECONNECT_DELAY = 0.5       # seconds between the attempts
+
+
+def encode_message(payload):
+    """Frames a payload so that it can be separated from the other messages in the stream
+
+    Args:
+        payload (bytes or str): message to be sent, strings are encoded as utf-8
+
+    Returns:
+        bytes: length header followed by the payload
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return HEADER.pack(len(payload)) + payload
+
+
+def parse_hint(message):
+    """Reads a reply to the Hint command
+
+    Args:
+        message (bytes): reply starting with HINT_PREFIX
+
+    Raises:
+        ValueError: When the reply is malformed
+
+    Returns:
+        tuple: (cards in the hand the hint is for, EV of standing, EV of hitting)
+    """
+    cards, stand, hit = message.decode()[len(HINT_PREFIX):].split(',')
+    return int(cards), float(stand), float(hit)
+
+
+class MessageReader:
+    def __init__(self):
+        """Reassembles the messages framed by encode_message from the bytes received
+        """
+        self.buffer = bytearray()
+        self.messages = deque()
+        self.received = 0       # bytes received in total
+
+    def feed(self, data):
+        """Adds received bytes to the buffer and extracts every complete message
+
+        Args:
+            data (bytes): bytes received from the socket
+
+        Raises:
+            ValueError: When the length header exceeds MAX_MESSAGE_SIZE
+
+        Returns:
+            deque: complete messages that have not been read yet
+        """
+        self.buffer += data
+        self.received += len(data)
+        start = 0
+        while len(self.buffer) - start >= HEADER.size:
+            (size,) = HEADER.unpack_from(self.buffer, start)
+            if size > MAX_MESSAGE_SIZE:
+                raise ValueError(f'Message of {size} bytes is too large')
+            end = start + HEADER.size + size
+            if end > len(self.buffer):
+                break
+            self.messages.append(bytes(self.buffer[start+HEADER.size:end]))
+            start = end
+        del self.buffer[:start]
+        return self.messages
+
+    def recv(self, sock, buff_size=8192):
+        """Blocks until a complete message is received
+
+        Args:
+            sock (Socket): communication channel
+            buff_size (int, optional): maximum bytes read per recv. Defaults to 8192.
+
+        Returns:
+            bytes: the message, or None if the connection was closed
+        """
+        while not self.messages:
+            data = sock.recv(buff_size)
+            if not data:
+                return None
+            self.feed(data)
+        return self.messages.popleft()
+
+    async def read(self, stream, buff_size=8192):
+        """Waits until a complete message is received from an asyncio stream
+
+        Args:
+            stream (StreamReader): communication channel
+            buff_size (int, optional): maximum bytes read at once. Defaults to 8192.
+
+        Returns:
+            bytes: the message, or None if the connection was closed
+        """
+        while not self.messages:
+            data = await stream.read(buff_size)
+            if not data:
+                return None
+            self.feed(data)
+        return self.messages.popleft()
+
 
 class Network:
-    def __init__(self, server_ip, port_no=5555, buff_size=8192, lobby_id='', name='Poh'):
+    def __init__(self, server_ip, port_no=5555, buff_size=8192, lobby_id='', name='Poh', listen=True, on_queue=None):
         """Creates a network class to handle network functionality for the client
 
         Args:
             server_ip (str): ip address of the server
             port_no (int, optional): port number of the server. Defaults to 5555.
-            buff_size (int, optional): size of the buffer to be sent. Defaults to 2048.
+            buff_size (int, optional): maximum bytes read per recv. Defaults to 8192.
+            listen (bool, optional): receive the table updates pushed by the server. Defaults to True.
+            on_queue (function, optional): called with the queue position while waiting for a seat. Defaults to None.
         """
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.addr = (server_ip, port_no)
         self.buff_size = buff_size
+        self.lobby_id = lobby_id
+        self.reader = MessageReader()
+        self.game = BlackjackTable()    # local replica of the table kept up to date by the server
+        self.updates = queue.Queue()    # patches pushed by the server, None once the connection is lost
+        self.closed = False
+        self.on_queue = on_queue
+        self.token = None               # resume token of the seat, given by the server once seated
+        self.hint = None                # (cards in the hand, EV of standing, EV of hitting) of the last reply to Hint
+        self.listener = None
         self.p_id = self.connect(lobby_id, name)
+        if listen and self.p_id is not None:
+            self.listener = threading.Thread(target=self.listen, daemon=True)
+            self.listener.start()
 
     def getP(self):
         return self.p_id
     
     def connect(self, lobby_id, name):
-        """Establishes a connection between the client and server. Once connection is enstablished, return the ID of the player
+        """Establishes a connection between the client and server. Once connection is enstablished, return the ID of the player.
+        Blocks while the player is waiting in the queue for a seat
 
         Returns:
             int: the playerID
@@ -28,23 +158,128 @@ class Network:
             self.client.connect(self.addr)
 
             # send lobby ID
-            self.client.sendall(str.encode(lobby_id + ',' + name))
-            return self.client.recv(self.buff_size).decode()
+            self.client.sendall(encode_message(lobby_id + ',' + name))
+            reply = self.reader.recv(self.client, self.buff_size).decode()
+            while reply.startswith('Queue,'):
+                if self.on_queue is not None:
+                    self.on_queue(int(reply.split(',')[1]))
+                reply = self.reader.recv(self.client, self.buff_size).decode()
+
+            # once seated, the player ID comes with the token to resume the seat
+            p_id, _, token = reply.partition(',')
+            if token:
+                self.token = token
+            return p_id
         except:
             pass
 
-    def send(self, data):
-        """Send data to the server
+    def reconnect(self, timeout=RECONNECT_TIMEOUT):
+        """Takes back the seat after the connection was lost. The server holds the seat for a grace
+        period and sends the whole table again, which replaces the local replica
 
         Args:
-            data (str): Data to be sent
+            timeout (float, optional): seconds to keep trying for. Defaults to RECONNECT_TIMEOUT.
+
+        Returns:
+            bool: if the seat was resumed
+        """
+        if self.token is None:
+            return False
+        self.close()
+        if self.listener is not None:
+            self.listener.join()
+
+        end = time.monotonic() + timeout
+        while True:
+            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.reader = MessageReader()
+            p_id = self.connect(self.lobby_id, RESUME_PREFIX + self.token)
+            if p_id is not None:
+                break
+            self.client.close()
+            if time.monotonic() + RECONNECT_DELAY > end:
+                return False
+            time.sleep(RECONNECT_DELAY)
+
+        # -4 if the seat is no longer held
+        if int(p_id) < 0:
+            self.client.close()
+            return False
+        self.p_id = p_id
+        self.game = BlackjackTable()
+        self.updates = queue.Queue()
+        self.closed = False
+        if self.listener is not None:
+            self.listener = threading.Thread(target=self.listen, daemon=True)
+            self.listener.start()
+        return True
+
+    def listen(self):
+        """Receives the patches pushed by the server until the connection is lost
+        """
+        try:
+            while True:
+                message = self.reader.recv(self.client, self.buff_size)
+                if message is None:
+                    break
+                if message.startswith(HINT_PREFIX.encode()):
+                    self.hint = parse_hint(message)
+                    continue
+                self.updates.put(decode_state(message))
+        except (OSError, ValueError):
+            pass
+        self.updates.put(None)
+
+    def poll(self, block=False, timeout=None):
+        """Applies the patches pushed by the server since the last poll
+
+        Args:
+            block (bool, optional): wait for at least one patch. Defaults to False.
+            timeout (float, optional): seconds to wait for when blocking, None to wait forever. Defaults to None.
 
         Returns:
-            BlackjackTable: Response from the server
+            BlackjackTable: local replica of the table, None if the connection is lost
+        """
+        while not self.closed:
+            try:
+                patch = self.updates.get(block=block, timeout=timeout)
+            except queue.Empty:
+                return self.game
+            block = False
+            if patch is None:
+                self.closed = True
+            else:
+                self.game.apply_patch(patch)
+        return None
+
+    def close(self):
+        """Closes the connection, which also stops the listener thread
+        """
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.client.close()
+
+    def recv(self):
+        """Waits for a reply from the server. Only for connections that do not listen for table updates
+
+        Returns:
+            str: the reply, None if the connection is lost
+        """
+        try:
+            message = self.reader.recv(self.client, self.buff_size)
+        except (OSError, ValueError):
+            return None
+        return None if message is None else message.decode()
+
+    def send(self, data):
+        """Send data to the server. The resulting changes are pushed back by the server
+
+        Args:
+            data (str): Data to be sent
         """
         try:
-            self.client.sendall(str.encode(data))
-            game = self.client.recv(self.buff_size)
-            return pickle.loads(game)
+            self.client.sendall(encode_message(data))
         except socket.error as e:
             print(e)
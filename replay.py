@@ -0,0 +1,280 @@
+import argparse
+import mmap
+import sys
+import time
+from datetime import datetime
+
+from blackjack import Player, Dealer, CARD_NAMES, DECK_SIZE
+from history import (HEADER, MAGIC, VERSION, RECORD, NAME_CHUNK, EVENT_NAMES, DEALER,
+                     JOIN, NAME, LEAVE, BET, DEAL, HIT, STAND, DRAW, SETTLE, MONEY, ABORT, CLEAR, START)
+
+
+class TableState:
+    def __init__(self):
+        """Table rebuilt from a hand history, checking every event against the rules of BlackjackTable
+        """
+        self.players = {}       # player ID -> Player
+        self.dealer = Dealer()
+        self.rounds = 0         # rounds dealt
+        self.settled = 0        # hands settled
+        self.errors = []        # (event index, message) of the events that break the rules
+
+    def error(self, index, message):
+        self.errors.append((index, message))
+
+    def player(self, index, seat):
+        """Looks up the player of a seat, reporting an error if the seat is empty
+
+        Args:
+            index (int): index of the event
+            seat (int): player ID
+
+        Returns:
+            Player: the player, a placeholder if the seat is empty so that the replay can go on
+        """
+        player = self.players.get(seat)
+        if player is None:
+            self.error(index, f'seat {seat} is empty')
+            player = self.players[seat] = Player(f'Unknown {seat}', 0)
+        return player
+
+    def apply(self, index, event, seat, card, extra, value, name):
+        """Applies one event
+
+        Args:
+            index (int): index of the event in the log
+            event (int): event code
+            seat (int): player ID or DEALER
+            card (int): card code
+            extra (int): has_won or the length of the name
+            value (int): money or bet
+            name (str): name of the player for JOIN events
+        """
+        if event in (DEAL, HIT, DRAW) and card >= DECK_SIZE:
+            self.error(index, f'invalid card {card}')
+            card = 0
+
+        if event == DEAL:
+            # the first card dealt starts the round
+            if not self.dealer.cards:
+                self.rounds += 1
+            if seat == DEALER:
+                self.dealer.get_cards(card)
+            else:
+                self.player(index, seat).get_cards(card)
+        elif event == HIT:
+            player = self.player(index, seat)
+            if player.cards.is_busted():
+                self.error(index, f'seat {seat} hit after busting')
+            player.get_cards(card)
+        elif event == DRAW:
+            if self.dealer.get_card_total() >= 17:
+                self.error(index, f'dealer drew on {self.dealer.get_card_total()}')
+            self.dealer.get_cards(card)
+        elif event == SETTLE:
+            self.settle(index, self.player(index, seat), extra, value)
+        elif event == BET:
+            # a player confirms again after someone leaves, with the whole bet, which replaces the one
+            # confirmed before. Bets are only confirmed before the cards are dealt
+            if self.dealer.cards:
+                self.error(index, f'seat {seat} bet during the round')
+            player = self.player(index, seat)
+            player.money += player.bet - value
+            player.bet = value
+            if value <= 0 or player.money < 0:
+                self.error(index, f'seat {seat} bet {value} out of {player.money + value}')
+        elif event == STAND:
+            self.player(index, seat)
+        elif event == JOIN:
+            if seat in self.players:
+                self.error(index, f'seat {seat} joined while taken')
+            self.players[seat] = Player(name, value)
+        elif event == LEAVE:
+            self.player(index, seat)
+            del self.players[seat]
+        elif event == MONEY:
+            self.player(index, seat).money += value
+        elif event == ABORT:
+            for player in self.players.values():
+                player.money += player.bet
+                player.bet = 0
+        elif event == CLEAR:
+            self.dealer = Dealer()
+            for player in self.players.values():
+                player.cards.clear()
+                player.has_won = None
+        elif event == START:
+            # the server restarted, a restored table logs its seats again after this
+            self.players = {}
+            self.dealer = Dealer()
+        else:
+            self.error(index, f'unknown event {event}')
+
+    def settle(self, index, player, has_won, money):
+        """Checks a settlement against the hands, with the rules of deal_cards_init and dealers_turn
+
+        Args:
+            index (int): index of the event
+            player (Player): player settled
+            has_won (int): outcome logged, 0 lost, 1 tie, 2 won
+            money (int): money logged after the settlement
+        """
+        total_dealer = self.dealer.get_card_total()
+        total_player = player.get_card_total()
+        if len(self.dealer.cards) == 2 and total_dealer == 21:
+            # the dealer blackjacked, only a blackjack ties
+            expected = 1 if len(player.cards) == 2 and total_player == 21 else 0
+        elif total_player > 21 or total_player < total_dealer <= 21:
+            expected = 0
+        elif total_player == total_dealer:
+            expected = 1
+        else:
+            expected = 2
+
+        # a tie gives the bet back and a win pays it twice
+        expected_money = player.money + expected * player.bet
+        if has_won != expected or money != expected_money:
+            self.error(index, f'{player.name} settled as {has_won} with ${money}, '
+                              f'expected {expected} with ${expected_money}')
+        # carry on from what the rules give, so that one wrong record is only reported once
+        player.has_won = expected
+        player.money = expected_money
+        player.bet = 0
+        self.settled += 1
+
+    def describe(self):
+        """Formats the table for the terminal
+
+        Returns:
+            str: one line for the dealer and one for each seat
+        """
+        def hand(cards):
+            return ' '.join(CARD_NAMES[card] for card in cards) or '-'
+
+        lines = [f'Dealer: {hand(self.dealer.cards)} ({self.dealer.get_card_total()})']
+        for seat, player in sorted(self.players.items()):
+            outcome = {None: '', 0: ', lost', 1: ', tie', 2: ', won'}[player.has_won]
+            lines.append(f'Seat {seat} {player.name}: ${player.money}, bet {player.bet}, '
+                         f'{hand(player.cards)} ({player.get_card_total()}){outcome}')
+        return '\n'.join(lines)
+
+
+def replay(path, stop_round=None, on_event=None):
+    """Rebuilds a table from its hand history, read through a memory map
+
+    Args:
+        path (str): path of the log
+        stop_round (int, optional): stop once this round is over, None to replay everything. Defaults to None.
+        on_event (function, optional): called with (index, time, event, seat, card, extra, value, name). Defaults to None.
+
+    Raises:
+        ValueError: When the file is not a hand history
+
+    Returns:
+        tuple: (TableState, number of events, bytes of partial record at the end)
+    """
+    state = TableState()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if len(data) < HEADER.size or HEADER.unpack_from(data)[:2] != (MAGIC, VERSION):
+            raise ValueError(f'{path} is not a hand history')
+        torn = (len(data) - HEADER.size) % RECORD.size
+        end = len(data) - torn
+
+        # names are gathered from the NAME records that follow their JOIN
+        joining = None
+        events = 0
+        with memoryview(data) as view, view[HEADER.size:end] as records:
+            for index, (event, seat, card, extra, value, t) in enumerate(RECORD.iter_unpack(records)):
+                if event == NAME:
+                    if joining is not None:
+                        offset = HEADER.size + index * RECORD.size + 1
+                        joining[1].append(data[offset:offset+NAME_CHUNK])
+                    continue
+                if joining is not None:
+                    finish_join(state, joining, on_event)
+                    joining = None
+                if stop_round is not None and event == CLEAR and state.rounds >= stop_round:
+                    break
+                events += 1
+                if event == JOIN:
+                    joining = [(index, t, event, seat, card, extra, value), []]
+                    continue
+                if on_event is not None:
+                    on_event(index, t, event, seat, card, extra, value, None)
+                state.apply(index, event, seat, card, extra, value, None)
+            if joining is not None:
+                finish_join(state, joining, on_event)
+    return state, events, torn
+
+
+def finish_join(state, joining, on_event):
+    """Applies a JOIN event once its name has been read
+
+    Args:
+        state (TableState): table being rebuilt
+        joining (list): fields of the JOIN record and the parts of the name
+        on_event (function): called with the event, None to not call anything
+    """
+    (index, t, event, seat, card, extra, value), parts = joining
+    name = b''.join(parts)[:extra].decode(errors='replace')
+    if on_event is not None:
+        on_event(index, t, event, seat, card, extra, value, name)
+    state.apply(index, event, seat, card, extra, value, name)
+
+
+def print_event(index, t, event, seat, card, extra, value, name):
+    """Prints an event as a line of text
+    """
+    when = datetime.fromtimestamp(t).isoformat(sep=' ', timespec='milliseconds')
+    who = 'dealer' if seat == DEALER or event == DRAW else f'seat {seat}'
+    if event in (DEAL, HIT, DRAW):
+        detail = CARD_NAMES[card] if card < DECK_SIZE else f'card {card}'
+    elif event == JOIN:
+        detail = f'{name}, ${value}'
+    elif event == SETTLE:
+        detail = f'{["lost", "tie", "won"][extra] if extra < 3 else extra}, ${value}'
+    elif event in (BET, MONEY):
+        detail = f'${value}'
+    else:
+        detail = ''
+    if event in (ABORT, CLEAR, START):
+        who = 'table'
+    name = EVENT_NAMES[event] if event < len(EVENT_NAMES) else f'event {event}'
+    print(f'{index:>8} {when} {who:<7} {name:<7} {detail}')
+
+
+def main():
+    # argparse
+    parser = argparse.ArgumentParser(description='Replays the hand history of a table, checking every event against the rules')
+    parser.add_argument('log', type=str, help='Hand history written by server.py -history')
+    parser.add_argument('-round', '--round', metavar='', type=int, help='Show the table as it was at the end of this round')
+    parser.add_argument('-events', '--events', action='store_true', help='Print every event')
+
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        state, events, torn = replay(args.log, args.round, print_event if args.events else None)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    if args.round is not None:
+        if state.rounds < args.round:
+            print(f'The log only has {state.rounds} rounds')
+        print(state.describe())
+    print(f'Events:   {events} in {elapsed:.3f} s ({events / max(elapsed, 1e-9):.0f} per s)')
+    print(f'Rounds:   {state.rounds}, {state.settled} hands settled')
+    if torn:
+        print(f'Ignored {torn} bytes of a partial record at the end of the log')
+    for index, message in state.errors[:20]:
+        print(f'Error at event {index}: {message}')
+    if state.errors:
+        print(f'{len(state.errors)} events break the rules')
+        sys.exit(1)
+    print('Every event follows the rules')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,118 +1,1341 @@
 import socket
-from _thread import *
-import pickle
+import asyncio
 from blackjack import *
+from codec import encode_state
+from network import encode_message, MessageReader, HEADER, RESUME_PREFIX, HINT_PREFIX
+from metrics import METRICS
+from bankroll import BankrollStore, release_seats
+from history import HandHistory, log_path
+from snapshot import encode_tables, write_snapshot, read_snapshot
+from strategy import HintCache, hand_key, expected_values, opening_hints, MAX_HINTS
 import argparse
+import glob
+import re
+import secrets
+import signal
+import threading
+import zlib
+import multiprocessing
+from multiprocessing.reduction import send_handle, recv_handle
 
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 
 ADMIN_KEY = 'kYeVsv1o2qfuBUP508rl'
+HANDSHAKE_TIMEOUT = 10          # seconds a new connection has to send the lobby ID
+MAX_WRITE_BUFFER = 1 << 20      # clients that fall further behind than this many bytes are dropped
+MAX_QUEUE = 10                  # players that can wait for a seat at each table
+GRACE_PERIOD = 30               # seconds the seat of a dropped connection is held for
+SNAPSHOT_INTERVAL = 10          # seconds between the snapshots of the tables
+GUEST_NAME = re.compile(r'Player \d+')  # names given to the players that did not choose one, their money is not kept
 
+# money, bets and the money logged in the hand history are packed as signed 64 bit integers
+MIN_AMOUNT = -1 << 63
+MAX_AMOUNT = (1 << 63) - 1
 
-def threaded_client(conn, count, game, lobby_id, buff_size=8192):
-    """Client thread. Spawns when new client is added
+# admin commands that change the table, with the number of arguments they repeat in
+ADMIN_COMMANDS = {'set_money': 2, 'add_money': 2, 'kick': 1, 'reset': 0}
+
+# messages from the players that change the table
+PLAYER_COMMANDS = {
+    'Ready': BlackjackTable.player_ready,
+    '-': BlackjackTable.sub_bet,
+    '+': BlackjackTable.add_bet,
+    'Bet': BlackjackTable.confirm_bet,
+    'Hit': BlackjackTable.hit,
+    'Stand': BlackjackTable.stand,
+    'Continue': BlackjackTable.reset,
+}
+
+
+class Publisher:
+    def __init__(self, game):
+        """Pushes the changes of a table to every subscribed client
+
+        Args:
+            game (BlackjackTable): shared game
+        """
+        self.game = game
+        self.subscribers = {}           # connection -> last state seen by the client
+        self.watchers = set()           # admin connections streaming the table events
+        self.state = game.snapshot()    # last state published
+
+    def subscribe(self, writer):
+        """Starts pushing updates to a client, beginning with the full state
+
+        Args:
+            writer (StreamWriter): communication channel
+        """
+        self.subscribers[writer] = None
+        self.push(self.state)
+
+    def unsubscribe(self, writer):
+        """Stops pushing updates to a client
+
+        Args:
+            writer (StreamWriter): communication channel
+        """
+        self.subscribers.pop(writer, None)
+
+    def resync(self, writer):
+        """Sends the full state to a client again
+
+        Args:
+            writer (StreamWriter): communication channel
+        """
+        if writer in self.subscribers:
+            self.subscribers[writer] = None
+            self.push(self.state)
+
+    def publish(self):
+        """Pushes the changes to the subscribers if the table has changed since the last publish
+        """
+        start = time.perf_counter()
+        state = self.game.snapshot()
+        METRICS.observe('snapshot', time.perf_counter() - start)
+        if state == self.state:
+            return
+        events = describe_patch(diff_snapshot(self.state, state)) if self.watchers else ''
+        # a player getting ready changes the table without an event worth showing
+        if events:
+            events = encode_message(events)
+            for writer in list(self.watchers):
+                if writer.is_closing():
+                    self.watchers.discard(writer)
+                else:
+                    writer.write(events)
+        self.state = state
+        self.push(state)
+
+    def push(self, state):
+        """Sends each subscriber the patch from the state it last saw
+
+        Args:
+            state (dict): current state of the table
+        """
+        # subscribers that saw the same state share the same encoded patch
+        encoded = {}
+        for writer, last_state in list(self.subscribers.items()):
+            if last_state is state:
+                continue
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                del self.subscribers[writer]
+                writer.close()
+                continue
+            key = id(last_state)
+            if key not in encoded:
+                start = time.perf_counter()
+                encoded[key] = encode_message(encode_state(diff_snapshot(last_state, state)))
+                METRICS.observe('serialize', time.perf_counter() - start)
+            writer.write(encoded[key])
+            METRICS.count('bytes out', len(encoded[key]))
+            self.subscribers[writer] = state
+
+
+def describe_patch(patch):
+    """Describes a patch from diff_snapshot as compact events for the admin console
 
     Args:
-        conn (Socket): communication channel
-        count (int): number of players that have tried to joined
-        game (BlackjackTable): shared game
-        buff_size (int, optional): buffer size to be sent. Defaults to 8192.
+        patch (dict): fields that changed
+
+    Returns:
+        str: one event per line
     """
+    events = []
+    if 'scene' in patch:
+        events.append(f'scene {patch["scene"]}')
+    if 'turn' in patch:
+        events.append(f'turn {patch["turn"]}')
+    if 'dealer' in patch or 'dealer_add' in patch:
+        cards = patch.get('dealer', patch.get('dealer_add'))
+        events.append(f'dealer {"cards" if "dealer" in patch else "draws"} {" ".join(CARD_NAMES[code] for code in cards)}')
+    for key, seat in patch.get('seats', {}).items():
+        if 'name' in seat:
+            events.append(f'seat {key} joined as {seat["name"]}')
+        fields = [f'{field} {seat[field]}' for field in ('money', 'bet', 'has_won') if field in seat]
+        if 'cards_add' in seat:
+            fields.append(f'draws {" ".join(CARD_NAMES[code] for code in seat["cards_add"])}')
+        if fields:
+            events.append(f'seat {key} ' + ', '.join(fields))
+    for key in patch.get('removed', ()):
+        events.append(f'seat {key} left')
+    return '\n'.join(events)
 
-    data = conn.recv(buff_size).decode()
-    lobby_id_parse, name = data.split(',')
 
-    if lobby_id_parse == lobby_id and name == ADMIN_KEY:
-        conn.sendall(str.encode(str('Admin')))
-        admin_client(conn, game, buff_size)
-        return
+def parse_admin_batch(line):
+    """Parses a batch of admin commands separated by ;, e.g. set_money 0 100 1 50; kick 3
 
-    # wrong lobby id
-    if lobby_id_parse != lobby_id:
-        conn.sendall(str.encode(str(-1)))
-        conn.close()
-        return
-    
-    # add player to the game
-    if name == '':
-        name = f'Player {count}'
-    new_player = Player(name)
-    err_code, in_game_id = game.join(new_player)
-
-    # lobby is too full
-    if err_code == -1:
-        conn.sendall(str.encode(str(-2)))
-        conn.close()
-        return
-
-    # send game id to client to let them know which ID they are
-    conn.sendall(str.encode(str(in_game_id)))
-
-    while True:
+    Args:
+        line (str): line typed in the admin console
+
+    Raises:
+        ValueError: When a command is unknown, has the wrong arguments or an amount too large to be stored
+
+    Returns:
+        list: (command, list of int arguments) in the order they are given
+    """
+    batch = []
+    for text in line.split(';'):
+        words = text.split()
+        if not words:
+            continue
+        command, args = words[0], words[1:]
+        if command not in ADMIN_COMMANDS:
+            raise ValueError(f'Command not found: {command}')
+        size = ADMIN_COMMANDS[command]
+        if (size == 0 and args) or (size > 0 and (not args or len(args) % size)):
+            raise ValueError(f'Wrong number of arguments for {command}')
         try:
-            # receive data
-            data = conn.recv(buff_size).decode()
-            
-            # just in case
-            if not data:
+            values = [int(arg) for arg in args]
+        except ValueError:
+            raise ValueError(f'Arguments of {command} must be integers') from None
+        if any(not MIN_AMOUNT <= value <= MAX_AMOUNT for value in values):
+            raise ValueError(f'Arguments of {command} must be between {MIN_AMOUNT} and {MAX_AMOUNT}')
+        batch.append((command, values))
+    return batch
+
+
+class Lobby:
+    def __init__(self, lobby_id, decks=DEFAULT_DECKS, penetration=DEFAULT_PENETRATION, max_queue=MAX_QUEUE, store=None,
+                 history=None, game=None):
+        """Table hosted for one lobby ID. Every change to the table goes through its inbox and is
+        applied by a single executor task, which publishes the table once per batch of commands
+
+        Args:
+            lobby_id (str): lobby ID of the table
+            decks (int, optional): number of decks in the shoe. Defaults to DEFAULT_DECKS.
+            penetration (float, optional): share of the shoe dealt before reshuffling. Defaults to DEFAULT_PENETRATION.
+            max_queue (int, optional): players that can wait for a seat. Defaults to MAX_QUEUE.
+            store (BankrollStore, optional): store the money of the players is saved to, None to not save it. Defaults to None.
+            history (HandHistory, optional): log the events of the table are written to, None to not log them. Defaults to None.
+            game (BlackjackTable, optional): table restored from a snapshot, None for a new table. Defaults to None.
+        """
+        self.lobby_id = lobby_id
+        self.game = BlackjackTable(decks, penetration) if game is None else game
+        self.game.history = history
+        self.game.record_table()
+        self.publisher = Publisher(self.game)
+        self.clients = 0    # connections using the table, including the ones waiting to join
+        self.max_queue = max_queue
+        self.waiting = deque()  # [player, future, writer, position reported] of the players waiting for a seat, first come first served
+        self.seats = {}         # player ID -> connection of the seated players
+        self.tokens = {}        # player ID -> resume token of the seated players
+        self.held = {}          # resume token -> (player ID, timer releasing the seat) of the dropped connections
+        self.inbox = asyncio.Queue()    # (command, writer, name, time submitted) of the changes waiting to be applied
+        self.executor = None            # task applying the commands, started with the first command
+        self.store = store
+        self.saved = {}         # username -> bankroll last saved for the seated players
+        self.names = set()      # names claimed in the store by the players seated or waiting at the table
+
+    def submit(self, command, writer=None, name=None):
+        """Queues a change to the table
+
+        Args:
+            command (function): function without arguments that changes the table
+            writer (StreamWriter, optional): connection that is closed if the command fails. Defaults to None.
+            name (str, optional): name the handling latency is recorded under, None to not record it. Defaults to None.
+        """
+        self.inbox.put_nowait((command, writer, name, time.perf_counter()))
+        # restart the executor should it ever have stopped, so that the table never stops applying commands
+        if self.executor is None or self.executor.done():
+            self.executor = asyncio.ensure_future(self.execute())
+
+    async def execute(self):
+        """Applies the commands in the order they were submitted. The commands that arrive while a
+        batch is applied are applied together, then the table is published once
+        """
+        while True:
+            batch = [await self.inbox.get()]
+            while not self.inbox.empty():
+                batch.append(self.inbox.get_nowait())
+            scene = self.game.scene
+            for command, writer, name, submitted in batch:
+                try:
+                    command()
+                except Exception:
+                    if writer is not None:
+                        writer.close()
+                if name is not None:
+                    METRICS.observe(f'command {name}', time.perf_counter() - submitted)
+            try:
+                self.after_batch(scene)
+            except Exception as e:
+                # the next batch publishes again, so one failure does not stop the table
+                print(f'{self}: Error after applying commands: {e!r}')
+
+    def after_batch(self, scene):
+        """Seats the waiting players and publishes the table once a batch of commands is applied
+
+        Args:
+            scene (int): scene of the table before the batch
+        """
+        self.admit()
+        self.publisher.publish()
+        if self.store is not None:
+            self.save_bankrolls()
+
+        # a round starts when the cards are dealt
+        if scene < 2 <= self.game.scene:
+            METRICS.event('rounds')
+
+        # the hand history is written out once per round
+        if scene < 3 <= self.game.scene and self.game.history is not None:
+            self.game.history.flush()
+
+    def save_bankrolls(self):
+        """Queues the bankroll of every seated player whose bankroll changed in the last batch, and
+        frees the names of the players that have left. A bet still counts as money until the cards
+        are dealt, so only dealing and settling a round save
+        """
+        dealt = self.game.scene >= 2
+        bankrolls = {}
+        for player in self.game.players.values():
+            # only the players that claimed their name own its bankroll
+            if player.name not in self.names:
+                continue
+            money = player.money if dealt else player.money + player.bet
+            bankrolls[player.name] = money
+            if self.saved.get(player.name) != money:
+                self.store.save(player.name, money)
+        self.saved = bankrolls
+
+        waiting = {entry[0].name for entry in self.waiting}
+        for name in self.names - bankrolls.keys() - waiting:
+            self.release_name(name)
+
+    def release_name(self, name):
+        """Frees a name claimed in the store
+
+        Args:
+            name (str): username
+        """
+        self.names.discard(name)
+        self.store.release(name)
+
+    def stop(self):
+        """Stops the executor and closes the hand history once the table is torn down
+        """
+        if self.executor is not None:
+            self.executor.cancel()
+            self.executor = None
+        if self.game.history is not None:
+            self.game.history.close()
+            self.game.history = None
+        for name in list(self.names):
+            self.release_name(name)
+
+    def request_seat(self, player, writer):
+        """Puts a player in the waiting queue, they are seated by the executor as soon as possible
+
+        Args:
+            player (Player): player that wants to join
+            writer (StreamWriter): communication channel the queue position is reported on
+
+        Returns:
+            Future: resolves to the player ID once seated, None if the queue is full
+        """
+        if len(self.waiting) >= self.max_queue and not self.can_seat():
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append([player, future, writer, None])
+        self.submit(self.admit)
+        return future
+
+    def leave_queue(self, future):
+        """Removes a player that gave up waiting, or unseats them if they were seated in the meantime
+
+        Args:
+            future (Future): future returned by request_seat
+        """
+        if future.done():
+            self.game.disconnect(future.result())
+            return
+        self.waiting = deque(entry for entry in self.waiting if entry[1] is not future)
+        future.cancel()
+
+    def can_seat(self):
+        return self.game.scene == 0 and self.game.get_id() != -1
+
+    def admit(self):
+        """Seats the waiting players in order while the table is between rounds and has free seats.
+        Runs after every batch of commands, since any of them can end a round or free a seat
+        """
+        while self.waiting and self.can_seat():
+            player, future, _, _ = self.waiting.popleft()
+            _, in_game_id = self.game.join(player)
+            future.set_result(in_game_id)
+        self.report_positions()
+
+    def report_positions(self):
+        """Tells each waiting player their position in the queue when it changes, 1 being the next to be seated
+        """
+        for position, entry in enumerate(self.waiting, 1):
+            if entry[3] != position:
+                entry[2].write(encode_message(f'Queue,{position}'))
+                entry[3] = position
+
+    def resume_tokens(self):
+        """Resume tokens of every seat, connected or held
+
+        Returns:
+            dict: player ID -> resume token
+        """
+        tokens = dict(self.tokens)
+        for token, (in_game_id, _) in self.held.items():
+            tokens[in_game_id] = token
+        return tokens
+
+    def __str__(self):
+        if self.lobby_id == '':
+            return 'Lobby (no ID)'
+        return f'Lobby {self.lobby_id}'
+
+
+class LobbyManager:
+    def __init__(self, lobby_id, multi_lobby=False, max_tables=1000, decks=DEFAULT_DECKS, penetration=DEFAULT_PENETRATION,
+                 max_queue=MAX_QUEUE, store=None, history_dir=None, host_default=True):
+        """Keeps a table for every lobby ID in use
+
+        Args:
+            lobby_id (str): lobby ID of the table that is always open
+            multi_lobby (bool, optional): open a table on demand for any other lobby ID. Defaults to False.
+            max_tables (int, optional): maximum number of tables open at once. Defaults to 1000.
+            decks (int, optional): number of decks in the shoe of each table. Defaults to DEFAULT_DECKS.
+            penetration (float, optional): share of the shoe dealt before reshuffling. Defaults to DEFAULT_PENETRATION.
+            max_queue (int, optional): players that can wait for a seat at each table. Defaults to MAX_QUEUE.
+            store (BankrollStore, optional): store the money of the players is kept in, None to start everyone with DEFAULT_MONEY. Defaults to None.
+            history_dir (str, optional): directory the hand history of each table is written to, None to not keep any. Defaults to None.
+            host_default (bool, optional): keep the table of lobby_id open, False in the worker processes that do not own it. Defaults to True.
+        """
+        self.default_id = lobby_id
+        self.multi_lobby = multi_lobby
+        self.max_tables = max_tables
+        self.decks = decks
+        self.penetration = penetration
+        self.max_queue = max_queue
+        self.store = store
+        self.history_dir = history_dir
+        self.lobbies = {lobby_id: self.create(lobby_id)} if host_default else {}
+
+    def create(self, lobby_id, game=None):
+        """Creates the table of a lobby
+
+        Args:
+            lobby_id (str): lobby ID of the table
+            game (BlackjackTable, optional): table restored from a snapshot, None for a new table. Defaults to None.
+
+        Returns:
+            Lobby: the new lobby
+        """
+        history = None
+        if self.history_dir is not None:
+            history = HandHistory(log_path(self.history_dir, lobby_id))
+        return Lobby(lobby_id, self.decks, self.penetration, self.max_queue, self.store, history, game)
+
+    def restore(self, lobby_id, game):
+        """Hosts a table restored from a snapshot
+
+        Args:
+            lobby_id (str): lobby ID of the table
+            game (BlackjackTable): restored table
+
+        Returns:
+            Lobby: lobby of the table, None if this server would not open a table for the lobby ID
+        """
+        old = self.lobbies.get(lobby_id)
+        if old is not None:
+            old.stop()
+        elif not self.multi_lobby or len(self.lobbies) >= self.max_tables:
+            return None
+        lobby = self.create(lobby_id, game)
+        self.lobbies[lobby_id] = lobby
+        return lobby
+
+    def open(self, lobby_id):
+        """Attaches a connection to the table of a lobby, creating the table if needed
+
+        Args:
+            lobby_id (str): lobby ID sent by the client
+
+        Returns:
+            Lobby: lobby of the table, None if the lobby ID is invalid or too many tables are open
+        """
+        lobby = self.lobbies.get(lobby_id)
+        if lobby is None:
+            if not self.multi_lobby or len(self.lobbies) >= self.max_tables:
+                return None
+            lobby = self.create(lobby_id)
+            self.lobbies[lobby_id] = lobby
+            print(f'{lobby}: Table opened')
+        lobby.clients += 1
+        return lobby
+
+    def stop(self):
+        """Stops every table once the server shuts down
+        """
+        for lobby in self.lobbies.values():
+            lobby.stop()
+
+    def close(self, lobby):
+        """Detaches a connection from its table and tears the table down once nobody uses it
+
+        Args:
+            lobby (Lobby): lobby returned by open
+        """
+        lobby.clients -= 1
+        if lobby.clients == 0 and lobby.lobby_id != self.default_id:
+            del self.lobbies[lobby.lobby_id]
+            lobby.stop()
+            print(f'{lobby}: Table closed')
+
+
+class Server:
+    def __init__(self, lobbies, max_connections=10000, buff_size=8192, grace=GRACE_PERIOD, snapshot=None,
+                 snapshot_interval=SNAPSHOT_INTERVAL, hints=None):
+        """Serves every client from a single thread with asyncio
+
+        Args:
+            lobbies (LobbyManager): tables hosted by the server
+            max_connections (int, optional): connections above this are closed straight away. Defaults to 10000.
+            buff_size (int, optional): maximum bytes read at once. Defaults to 8192.
+            grace (float, optional): seconds the seat of a dropped connection is held for, 0 to free it straight away. Defaults to GRACE_PERIOD.
+            snapshot (str, optional): file the tables are saved to periodically and on shutdown, None to not save them. Defaults to None.
+            snapshot_interval (float, optional): seconds between the snapshots. Defaults to SNAPSHOT_INTERVAL.
+            hints (HintCache, optional): cache the Hint command is answered from, None to ignore the command. Defaults to None.
+        """
+        self.lobbies = lobbies
+        self.max_connections = max_connections
+        self.grace = grace
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self.restored = []              # (lobby, resume tokens) of the restored tables, their seats are held once serving
+        self.buff_size = buff_size
+        self.count = 0                  # number of players that have tried to joined
+        self.connections = {}           # writer -> task of every open connection
+        self.closing = asyncio.Event()  # set by the admin shutdown command
+        self.hints = hints
+        # hints are pure Python and take up to a few hundred milliseconds, so they are worked out in
+        # another process that would otherwise hold the GIL the tables need. The process keeps its
+        # dealer tables from one hint to the next, the hints themselves are kept here
+        self.hint_executor = None
+        if hints is not None:
+            self.hint_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        self.computing = {}             # hand_key -> future of the hints being worked out
+
+    async def serve(self, sock):
+        """Accepts clients until the server is shut down
+
+        Args:
+            sock (Socket): bound listening socket
+        """
+        loop = asyncio.get_running_loop()
+        if os.name != 'nt':
+            loop.add_signal_handler(signal.SIGTERM, self.closing.set)
+        snapshots = self.start_snapshots()
+        server = await asyncio.start_server(self.handle_client, sock=sock)
+        await self.closing.wait()
+        server.close()
+        await self.stop_snapshots(snapshots)
+
+        # closing the connections ends the client coroutines, wait for them to clean up
+        for writer in self.connections:
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        self.lobbies.stop()
+        self.stop_hints()
+        await server.wait_closed()
+
+    async def serve_worker(self, pipe):
+        """Runs the clients handed over by the router until the server is shut down
+
+        Args:
+            pipe (Connection): duplex pipe to the router
+        """
+        loop = asyncio.get_running_loop()
+        snapshots = self.start_snapshots()
+        threading.Thread(target=self.receive_connections, args=(pipe, loop), daemon=True).start()
+        await self.closing.wait()
+        await self.stop_snapshots(snapshots)
+        for writer in self.connections:
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        self.lobbies.stop()
+        self.stop_hints()
+
+    def restore(self, tables):
+        """Hosts the tables of a snapshot. The seated players get their seat held for the grace
+        period, so that their clients can resume it once the server is back
+
+        Args:
+            tables (list): (lobby ID, BlackjackTable, resume tokens) returned by load_snapshots
+        """
+        for lobby_id, game, tokens in tables:
+            lobby = self.lobbies.restore(lobby_id, game)
+            if lobby is None:
+                continue
+
+            # players without a token cannot resume their seat, and a table nobody can come back to is not kept
+            for key in list(game.players):
+                if int(key) not in tokens:
+                    game.disconnect(key)
+            if not game.players and lobby_id != self.lobbies.default_id:
+                del self.lobbies.lobbies[lobby_id]
+                lobby.stop()
+                continue
+
+            # the players get their names back, the store is only shared with workers that are starting too
+            if lobby.store is not None:
+                for player in game.players.values():
+                    if not GUEST_NAME.fullmatch(player.name) and lobby.store.claim(player.name):
+                        lobby.names.add(player.name)
+            self.restored.append((lobby, tokens))
+
+    def start_snapshots(self):
+        """Holds the seats of the restored tables and starts the periodic snapshots
+
+        Returns:
+            Task: task taking the periodic snapshots, None if there are none
+        """
+        for lobby, tokens in self.restored:
+            for in_game_id, token in tokens.items():
+                self.hold_seat(lobby, token, in_game_id)
+        self.restored = []
+        if self.snapshot is None:
+            return None
+        return asyncio.ensure_future(self.take_snapshots())
+
+    async def stop_snapshots(self, task):
+        """Stops the periodic snapshots and takes a last one, before the connections are closed
+
+        Args:
+            task (Task): task returned by start_snapshots
+        """
+        if task is None:
+            return
+        task.cancel()
+        await asyncio.wait((task,))
+        await self.save_snapshot()
+
+    async def take_snapshots(self):
+        """Saves the tables every snapshot interval
+        """
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save_snapshot()
+
+    async def save_snapshot(self):
+        """Saves every table. The tables are encoded on the event loop, where they cannot change
+        halfway, and written to the disk by another thread
+        """
+        start = time.perf_counter()
+        data = encode_tables([(lobby.lobby_id, lobby.game, lobby.resume_tokens())
+                              for lobby in self.lobbies.lobbies.values()])
+        METRICS.observe('encode snapshot', time.perf_counter() - start)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write_snapshot, self.snapshot, data)
+        except OSError as e:
+            print(f'Snapshot failed: {e}')
+
+    def receive_connections(self, pipe, loop):
+        """Thread that receives the connections handed over by the router
+
+        Args:
+            pipe (Connection): duplex pipe to the router
+            loop (AbstractEventLoop): event loop of the worker
+        """
+        try:
+            while True:
+                msg = pipe.recv()
+                if msg[0] == 'shutdown':
+                    break
+                _, handshake, leftover, count = msg
+                fd = recv_handle(pipe)
+                loop.call_soon_threadsafe(self.adopt, fd, handshake, leftover, count)
+        except (EOFError, OSError):
+            pass
+        loop.call_soon_threadsafe(self.closing.set)
+
+    def adopt(self, fd, handshake, leftover, count):
+        """Starts serving a connection handed over by the router
+
+        Args:
+            fd (int): file descriptor of the connection
+            handshake (bytes): handshake already read by the router
+            leftover (bytes): bytes received after the handshake
+            count (int): number of players that have tried to joined
+        """
+        async def run():
+            sock = socket.socket(fileno=fd)
+            reader, writer = await asyncio.open_connection(sock=sock)
+            messages = MessageReader()
+            messages.feed(leftover)
+            await self.handle_client(reader, writer, handshake, messages, count)
+        asyncio.ensure_future(run())
+
+    async def handle_client(self, reader, writer, handshake=None, messages=None, count=None):
+        """Runs for each accepted connection until it is closed
+
+        Args:
+            reader (StreamReader): incoming side of the connection
+            writer (StreamWriter): outgoing side of the connection
+            handshake (bytes, optional): handshake already read by the router. Defaults to None.
+            messages (MessageReader, optional): messages already received by the router. Defaults to None.
+            count (int, optional): number of players that have tried to joined, counted by the router. Defaults to None.
+        """
+        if len(self.connections) >= self.max_connections:
+            writer.close()
+            return
+        if count is None:
+            print(f'Connected to: {writer.get_extra_info("peername")}')
+            self.count += 1
+            count = self.count
+        self.connections[writer] = asyncio.current_task()
+        try:
+            await self.client(reader, writer, count, handshake, messages or MessageReader())
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+    async def client(self, reader, writer, count, handshake, messages):
+        """Handshake, then hands the connection to the table of its lobby
+
+        Args:
+            reader (StreamReader): incoming side of the connection
+            writer (StreamWriter): outgoing side of the connection
+            count (int): number of players that have tried to joined
+            handshake (bytes): handshake already read by the router, None to read it here
+            messages (MessageReader): messages received on the connection
+        """
+        if handshake is None:
+            handshake = await asyncio.wait_for(messages.read(reader, self.buff_size), HANDSHAKE_TIMEOUT)
+            if handshake is None:
+                return
+        lobby_id_parse, name = handshake.decode().split(',', 1)
+
+        # wrong lobby id
+        lobby = self.lobbies.open(lobby_id_parse)
+        if lobby is None:
+            writer.write(encode_message(str(-1)))
+            return
+
+        try:
+            if name == ADMIN_KEY:
+                writer.write(encode_message('Admin'))
+                await self.admin_client(lobby, reader, writer, messages)
+            elif name.startswith(RESUME_PREFIX):
+                await self.resume_client(lobby, reader, writer, messages, name[len(RESUME_PREFIX):])
+            else:
+                if name == '':
+                    name = f'Player {count}'
+                await self.player_client(lobby, reader, writer, messages, name)
+        finally:
+            self.lobbies.close(lobby)
+
+    async def player_client(self, lobby, reader, writer, messages, name):
+        """Seats the player, then runs their commands
+
+        Args:
+            lobby (Lobby): lobby the player joined
+            reader (StreamReader): incoming side of the connection
+            writer (StreamWriter): outgoing side of the connection
+            messages (MessageReader): messages received after the handshake
+            name (str): name of the player
+        """
+        game = lobby.game
+
+        # returning players get back the money they left with, unless they had run out. Only one
+        # player can be seated under a name, and the names given to guests do not keep any money
+        money = DEFAULT_MONEY
+        store = self.lobbies.store
+        claimed = False
+        if store is not None and not GUEST_NAME.fullmatch(name):
+            loop = asyncio.get_running_loop()
+            if not await loop.run_in_executor(None, store.claim, name):
+                # -5 if the name is taken
+                writer.write(encode_message(str(-5)))
+                return
+            claimed = True
+            try:
+                saved = await loop.run_in_executor(None, store.load, name)
+            except Exception:
+                store.release(name)
+                raise
+            if saved is not None and saved > 0:
+                money = saved
+
+        # players that join mid round or at a full table wait in the queue
+        future = lobby.request_seat(Player(name, money), writer)
+        if future is None:
+            if claimed:
+                store.release(name)
+            # -2 if the table is full, -3 if only the round is in progress
+            writer.write(encode_message(str(-2 if game.get_id() == -1 else -3)))
+            return
+        if claimed:
+            lobby.names.add(name)
+        in_game_id = await self.wait_for_seat(lobby, future, reader, messages)
+        if in_game_id is None:
+            return
+        await self.seated_client(lobby, reader, writer, messages, in_game_id)
+
+    async def resume_client(self, lobby, reader, writer, messages, token):
+        """Reattaches a reconnecting player to the seat held since their connection dropped
+
+        Args:
+            lobby (Lobby): lobby the player was seated in
+            reader (StreamReader): incoming side of the connection
+            writer (StreamWriter): outgoing side of the connection
+            messages (MessageReader): messages received after the handshake
+            token (str): resume token the player was given when seated
+        """
+        held = lobby.held.pop(token, None)
+        if held is None:
+            # -4 if the seat is no longer held
+            writer.write(encode_message(str(-4)))
+            return
+        in_game_id, timer = held
+        timer.cancel()
+
+        # the held seat now belongs to this connection, which has opened the lobby itself
+        lobby.clients -= 1
+        print(f'{lobby}, Player {in_game_id}: Resumed')
+        await self.seated_client(lobby, reader, writer, messages, in_game_id)
+
+    async def seated_client(self, lobby, reader, writer, messages, in_game_id):
+        """Runs the commands of a seated player. If the connection drops, the seat is held for the
+        grace period so that the player can resume it instead of leaving the table
+
+        Args:
+            lobby (Lobby): lobby the player is seated in
+            reader (StreamReader): incoming side of the connection
+            writer (StreamWriter): outgoing side of the connection
+            messages (MessageReader): messages received after the seat was taken
+            in_game_id (int): player ID
+        """
+        game = lobby.game
+        publisher = lobby.publisher
+
+        # send game id to client to let them know which ID they are, with a new token to resume the seat
+        token = secrets.token_hex(16)
+        writer.write(encode_message(f'{in_game_id},{token}'))
+        publisher.subscribe(writer)
+        lobby.seats[in_game_id] = writer
+        lobby.tokens[in_game_id] = token
+
+        # the client is only sent something when the table changes
+        leaving = False
+        try:
+            while True:
+                # receive data
+                data = await messages.read(reader, self.buff_size)
+
+                # just in case
+                if data is None:
+                    break
+                METRICS.count('bytes in', HEADER.size + len(data))
+                data = data.decode()
+
+                # possible moves to do in the game, the connection is closed if a move fails
+                if data == 'get':
+                    publisher.resync(writer)
+                elif data == 'Leave':
+                    leaving = True
+                    break
+                elif data == 'Hint':
+                    self.hint(lobby, writer, in_game_id)
+                elif data in PLAYER_COMMANDS:
+                    lobby.submit(partial(PLAYER_COMMANDS[data], game, in_game_id), writer, data)
+        except Exception:
+            pass
+        finally:
+            publisher.unsubscribe(writer)
+
+            # the seat is only held if the connection dropped, not if the player left or was kicked
+            kicked = lobby.seats.get(in_game_id) is not writer
+            lobby.seats.pop(in_game_id, None)
+            if lobby.tokens.get(in_game_id) == token:
+                del lobby.tokens[in_game_id]
+            if not kicked and not leaving and self.grace > 0:
+                print(f'{lobby}, Player {in_game_id}: Connection lost, seat held for {self.grace:g} s')
+                self.hold_seat(lobby, token, in_game_id)
+            else:
+                print(f'{lobby}, Player {in_game_id}: Connection lost')
+                lobby.submit(partial(game.disconnect, in_game_id), name='disconnect')
+
+    def precompute_hints(self, decks, upcard=1, start=None, count=0):
+        """Works out the hints of the hands dealt from a whole shoe in the hint process, one upcard
+        at a time so that the hints asked for by the players in the meantime only wait for one
+
+        Args:
+            decks (int): number of decks in the shoe
+            upcard (int, optional): next upcard to work out. Defaults to 1.
+            start (float, optional): time the first upcard was submitted, None if this is the first. Defaults to None.
+            count (int, optional): hints worked out so far. Defaults to 0.
+        """
+        if self.hint_executor is None:
+            return
+        if start is None:
+            start = time.perf_counter()
+        if upcard > 10:
+            print(f'Precomputed {count} hints in {time.perf_counter() - start:.1f} s')
+            return
+        try:
+            future = self.hint_executor.submit(opening_hints, decks, upcard)
+        except RuntimeError:
+            # the server is shutting down
+            return
+        future.add_done_callback(partial(self.hints_precomputed, decks, upcard, start, count))
+
+    def hints_precomputed(self, decks, upcard, start, count, future):
+        """Keeps the hints of an upcard and goes on with the next one. Called from a thread of the executor
+
+        Args:
+            decks (int): number of decks in the shoe
+            upcard (int): upcard worked out
+            start (float): time the first upcard was submitted
+            count (int): hints worked out before this upcard
+            future (Future): future of opening_hints
+        """
+        if future.cancelled() or future.exception() is not None:
+            return
+        hints = future.result()
+        for key, hint in hints.items():
+            self.hints.put(key, hint)
+        self.precompute_hints(decks, upcard + 1, start, count + len(hints))
+
+    def stop_hints(self):
+        """Stops the hint process once the server shuts down, after the hint or the upcard it is
+        working out
+        """
+        if self.hint_executor is not None:
+            self.hint_executor.shutdown(cancel_futures=True)
+
+    def hint(self, lobby, writer, in_game_id):
+        """Answers the Hint command with the expected values of standing and hitting the player's hand.
+        Cached hints are sent straight away, the others are worked out in the hint process so that
+        the tables never wait for them
+
+        Args:
+            lobby (Lobby): lobby the player is seated in
+            writer (StreamWriter): connection of the player
+            in_game_id (int): player ID
+        """
+        if self.hints is None:
+            return
+        start = time.perf_counter()
+        key = hand_key(lobby.game, in_game_id)
+        if key is None:
+            return
+        cards = len(lobby.game.players[str(in_game_id)].cards)
+        hint = self.hints.get(key)
+        if hint is not None:
+            self.send_hint(writer, cards, hint)
+            METRICS.observe('hint cached', time.perf_counter() - start)
+            return
+
+        # players asking about the same hand share the work
+        future = self.computing.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.hint_executor, expected_values, *key)
+            self.computing[key] = future
+            future.add_done_callback(partial(self.hint_worked_out, key))
+        future.add_done_callback(partial(self.hint_computed, writer, cards, start))
+
+    def hint_worked_out(self, key, future):
+        """Keeps a hint once it has been worked out
+
+        Args:
+            key (tuple): situation returned by hand_key
+            future (Future): future of expected_values
+        """
+        self.computing.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.hints.put(key, future.result())
+
+    def hint_computed(self, writer, cards, start, future):
+        """Sends a hint once it has been worked out
+
+        Args:
+            writer (StreamWriter): connection of the player
+            cards (int): number of cards in the hand the hint is for
+            start (float): time the hint was asked for
+            future (Future): future of expected_values
+        """
+        if future.cancelled() or future.exception() is not None or writer.is_closing():
+            return
+        self.send_hint(writer, cards, future.result())
+        METRICS.observe('hint computed', time.perf_counter() - start)
+
+    def send_hint(self, writer, cards, hint):
+        """Sends a hint to a player, with the number of cards in the hand so that the client can
+        tell if it is still about the hand on screen
+
+        Args:
+            writer (StreamWriter): connection of the player
+            cards (int): number of cards in the hand the hint is for
+            hint (tuple): expected values of standing and hitting
+        """
+        stand, hit = hint
+        writer.write(encode_message(f'{HINT_PREFIX}{cards},{stand:.6f},{hit:.6f}'))
+
+    def hold_seat(self, lobby, token, in_game_id):
+        """Keeps a seat at the table for the grace period, the table waits for the player meanwhile
+
+        Args:
+            lobby (Lobby): lobby of the seat
+            token (str): resume token of the seat
+            in_game_id (int): player ID
+        """
+        # the held seat keeps the table open
+        lobby.clients += 1
+        timer = asyncio.get_running_loop().call_later(self.grace, self.release_seat, lobby, token)
+        lobby.held[token] = (in_game_id, timer)
+
+    def release_seat(self, lobby, token):
+        """Gives up a held seat once the grace period is over
+
+        Args:
+            lobby (Lobby): lobby of the seat
+            token (str): resume token of the seat
+        """
+        held = lobby.held.pop(token, None)
+        if held is None:
+            return
+        in_game_id, timer = held
+        timer.cancel()
+        print(f'{lobby}, Player {in_game_id}: Seat released')
+        lobby.submit(partial(lobby.game.disconnect, in_game_id), name='disconnect')
+        self.lobbies.close(lobby)
+
+    async def wait_for_seat(self, lobby, future, reader, messages):
+        """Waits in the queue until the player is seated, while watching for the client leaving
+
+        Args:
+            lobby (Lobby): lobby the player joined
+            future (Future): future returned by request_seat
+            reader (StreamReader): incoming side of the connection
+            messages (MessageReader): messages received after the handshake
+
+        Returns:
+            int: player ID, None if the client left before being seated
+        """
+        read = None
+        seated = False
+        try:
+            while not future.done():
+                # anything the client sends before being seated is ignored
+                if read is None:
+                    read = asyncio.ensure_future(messages.read(reader, self.buff_size))
+                await asyncio.wait((future, read), return_when=asyncio.FIRST_COMPLETED)
+                if future.done():
+                    break
+                if read.result() is None:
+                    return None
+                read = None
+            seated = True
+            return future.result()
+        finally:
+            # the read has to be over before the connection can be read again
+            if read is not None:
+                read.cancel()
+                await asyncio.wait((read,))
+            if not seated:
+                lobby.submit(partial(lobby.leave_queue, future))
+
+    def stats(self):
+        """Metrics of this process for the admin console
+
+        Returns:
+            str: one metric per line
+        """
+        lobbies = self.lobbies.lobbies.values()
+        return METRICS.report({
+            'Process': os.getpid(),
+            'Connections': len(self.connections),
+            'Threads': threading.active_count(),
+            'Tables': len(lobbies),
+            'Players seated': sum(len(lobby.game.players) for lobby in lobbies),
+            'Players queued': sum(len(lobby.waiting) for lobby in lobbies),
+            'Hints': 'off' if self.hints is None else self.hints.stats(),
+        })
+
+    async def admin_client(self, lobby, reader, writer, messages):
+        """Runs the admin console commands on the table of a lobby
+
+        Args:
+            lobby (Lobby): lobby the admin logged into
+            reader (StreamReader): incoming side of the connection
+            writer (StreamWriter): outgoing side of the connection
+            messages (MessageReader): messages received after the handshake
+        """
+        print(f'{lobby}: Console login')
+        while True:
+            try:
+                # receive data
+                data = await messages.read(reader, self.buff_size)
+
+                # just in case
+                if data is None:
+                    break
+                METRICS.count('bytes in', HEADER.size + len(data))
+                data = data.decode()
+
+                cmd = data.split()
+                if not cmd:
+                    continue
+
+                # Admin console, every command is answered with a short reply
+                if cmd[0] == 'shutdown':
+                    self.closing.set()
+                    break
+                elif cmd[0] == 'stats':
+                    writer.write(encode_message(self.stats()))
+                elif cmd[0] == 'watch':
+                    lobby.publisher.watchers.add(writer)
+                    writer.write(encode_message('OK'))
+                elif cmd[0] == 'unwatch':
+                    lobby.publisher.watchers.discard(writer)
+                    writer.write(encode_message('OK'))
+                else:
+                    # the whole batch is applied at once and published once
+                    try:
+                        batch = parse_admin_batch(data)
+                    except ValueError as e:
+                        writer.write(encode_message(f'Error: {e}'))
+                        continue
+                    lobby.submit(partial(self.apply_admin_batch, lobby, batch, writer), name='admin')
+            except Exception:
                 break
+        lobby.publisher.watchers.discard(writer)
+        print(f'{lobby}: Admin connection lost')
+
+    def apply_admin_batch(self, lobby, batch, writer):
+        """Applies a batch of admin commands to the table, then replies OK or the seats that were not found
+
+        Args:
+            lobby (Lobby): lobby the admin logged into
+            batch (list): commands returned by parse_admin_batch
+            writer (StreamWriter): connection of the admin
+        """
+        game = lobby.game
+        missing = []
+        too_large = []
+        for command, args in batch:
+            if command == 'reset':
+                game.abort_round()
+                continue
+            size = ADMIN_COMMANDS[command]
+            for i in range(0, len(args), size):
+                player_id = args[i]
+                if str(player_id) not in game.players:
+                    missing.append(str(player_id))
+                elif command in ('set_money', 'add_money'):
+                    # the change is logged too, so both the money and the change have to fit
+                    money = game.players[str(player_id)].money
+                    amount = args[i+1] if command == 'set_money' else money + args[i+1]
+                    if not (MIN_AMOUNT <= amount <= MAX_AMOUNT and MIN_AMOUNT <= amount - money <= MAX_AMOUNT):
+                        too_large.append(str(player_id))
+                    else:
+                        game.set_money(player_id, amount)
+                elif command == 'kick' and player_id in lobby.seats:
+                    # the player is removed from the table once their connection is closed
+                    lobby.seats.pop(player_id).close()
+                elif command == 'kick':
+                    # a seat held for a dropped connection is given up straight away
+                    for token, (held_id, _) in list(lobby.held.items()):
+                        if held_id == player_id:
+                            self.release_seat(lobby, token)
+        if missing:
+            writer.write(encode_message(f'Error: no player {", ".join(missing)}'))
+        elif too_large:
+            writer.write(encode_message(f'Error: money of player {", ".join(too_large)} out of range'))
+        else:
+            writer.write(encode_message('OK'))
+
+
+class Router:
+    def __init__(self, workers, buff_size=8192):
+        """Accepts the clients and hands each connection to the worker process that owns its lobby
 
-            # possible moves to do in the game
-            if data == 'get':
+        Args:
+            workers (list): (Process, Connection) of every worker
+            buff_size (int, optional): maximum bytes read at once. Defaults to 8192.
+        """
+        self.workers = workers
+        self.buff_size = buff_size
+        self.count = 0                  # number of players that have tried to joined
+        self.closing = asyncio.Event()  # set once a worker has been shut down by an admin
+        # one thread per worker pipe, so that the connections are handed over off the event loop one at a time
+        self.handoffs = [ThreadPoolExecutor(max_workers=1) for _ in workers]
+
+    async def serve(self, sock):
+        """Accepts clients until the server is shut down
+
+        Args:
+            sock (Socket): bound listening socket
+        """
+        loop = asyncio.get_running_loop()
+        # a worker that stops, e.g. after an admin shut it down, shuts the whole server down
+        exits = [loop.run_in_executor(None, process.join) for process, _ in self.workers]
+        for future in exits:
+            future.add_done_callback(lambda _: self.closing.set())
+
+        if os.name != 'nt':
+            loop.add_signal_handler(signal.SIGTERM, self.closing.set)
+        server = await asyncio.start_server(self.route, sock=sock)
+        await self.closing.wait()
+        server.close()
+        for (_, pipe), handoff in zip(self.workers, self.handoffs):
+            try:
+                await loop.run_in_executor(handoff, pipe.send, ('shutdown',))
+            except OSError:
                 pass
-            elif data == 'Ready':
-                game.player_ready(in_game_id)
-            elif data == '-':
-                game.sub_bet(in_game_id)
-            elif data == '+':
-                game.add_bet(in_game_id)
-            elif data == 'Bet':
-                game.confirm_bet(in_game_id)
-            elif data == 'Hit':
-                game.hit(in_game_id)
-            elif data == 'Stand':
-                game.stand(in_game_id)
-            elif data == 'Continue':
-                game.reset(in_game_id)
-
-            conn.sendall(pickle.dumps(game))
-        except:
-            break
-    print(f'Player {in_game_id}: Connection lost')
-    conn.close()
-    game.disconnect(in_game_id)
-
-
-def admin_client(conn, game, buff_size):
-    print('Console login')
-    while True:
+        await asyncio.gather(*exits)
+        for handoff in self.handoffs:
+            handoff.shutdown()
+        await server.wait_closed()
+
+    def hand_over(self, pipe, pid, fd, handshake, leftover, count):
+        """Sends a connection to a worker, on the thread of its pipe. On macOS send_handle waits for
+        the worker to acknowledge the file descriptor, which is the only read made on the pipe
+
+        Args:
+            pipe (Connection): duplex pipe to the worker
+            pid (int): process ID of the worker
+            fd (int): file descriptor of the connection
+            handshake (bytes): handshake read from the connection
+            leftover (bytes): bytes received after the handshake
+            count (int): number of players that have tried to joined
+        """
+        pipe.send(('connection', handshake, leftover, count))
+        send_handle(pipe, fd, pid)
+
+    async def route(self, reader, writer):
+        """Reads the handshake of a new connection and hands the connection over
+
+        Args:
+            reader (StreamReader): incoming side of the connection
+            writer (StreamWriter): outgoing side of the connection
+        """
+        print(f'Connected to: {writer.get_extra_info("peername")}')
+        self.count += 1
+        count = self.count
+        messages = MessageReader()
         try:
-            # receive data
-            data = conn.recv(buff_size).decode()
-            
-            # just in case
-            if not data:
-                break
-            
-            cmd = data.split()
-            # Admin console
-            if cmd[0] == 'shutdown':
-                os._exit(1)
-            elif cmd[0] == 'set_money':
-                player_id = int(cmd[1])
-                amount = int(cmd[2])
-                game.set_money(player_id, amount)
-            else:
-                print('Command not found')
+            handshake = await asyncio.wait_for(messages.read(reader, self.buff_size), HANDSHAKE_TIMEOUT)
+            if handshake is not None:
+                # the lobby ID picks the worker so that all the players of a table end up together
+                lobby_id = handshake.split(b',', 1)[0]
+                index = worker_index(lobby_id, len(self.workers))
+                process, pipe = self.workers[index]
+                leftover = b''.join(encode_message(msg) for msg in messages.messages) + bytes(messages.buffer)
+                fd = writer.get_extra_info('socket').fileno()
+                await asyncio.get_running_loop().run_in_executor(
+                    self.handoffs[index], self.hand_over, pipe, process.pid, fd, handshake, leftover, count)
+        except (OSError, ValueError, RuntimeError, asyncio.TimeoutError):
+            # RuntimeError if the server shut down in the meantime
+            pass
+        # the worker has its own copy of the connection
+        writer.transport.abort()
+
+
+def worker_index(lobby_id, workers):
+    """Picks the worker process that owns a lobby, so that all the players of a table end up together
+
+    Args:
+        lobby_id (bytes): lobby ID
+        workers (int): number of worker processes
+
+    Returns:
+        int: index of the worker
+    """
+    return zlib.crc32(lobby_id) % workers
+
+
+def load_snapshots(path, worker=None, workers=0):
+    """Loads the tables of the snapshots written by the main process or by any of the worker processes
 
-            conn.sendall(pickle.dumps(game))
-        except:
-            break
-    print(f'Admin connection lost')
-    conn.close()
+    Args:
+        path (str): path of the snapshot given with -snapshot
+        worker (int, optional): only load the tables owned by this worker, None to load every table. Defaults to None.
+        workers (int, optional): number of worker processes. Defaults to 0.
+
+    Returns:
+        list: (lobby ID, BlackjackTable, resume tokens) of every table
+    """
+    # the worker processes write to path.0, path.1, ... and the newest snapshot of a table wins
+    paths = [name for name in glob.glob(glob.escape(path) + '.*') if re.fullmatch(r'\.\d+', name[len(path):])]
+    modified = {}
+    for name in [path] * os.path.exists(path) + paths:
+        try:
+            modified[name] = os.path.getmtime(name)
+        except OSError as e:
+            # removed since it was listed
+            print(f'Could not restore {name}: {e}')
+    tables = {}
+    for name in sorted(modified, key=modified.get):
+        try:
+            for table in read_snapshot(name):
+                tables[table[0]] = table
+        except (OSError, ValueError) as e:
+            print(f'Could not restore {name}: {e}')
+    return [table for lobby_id, table in tables.items()
+            if worker is None or worker_index(lobby_id.encode(), workers) == worker]
+
+
+def create_server(args, worker=None):
+    """Creates the tables and the server from the command line arguments
+
+    Args:
+        args (Namespace): parsed command line arguments
+        worker (int, optional): index of the worker process, None if the tables are hosted in the main process. Defaults to None.
+
+    Returns:
+        tuple: (Server, BankrollStore or None)
+    """
+    # the workers share the database, SQLite serializes their writes
+    store = None if args.bankroll is None else BankrollStore(args.bankroll)
+    # only the worker owning the default lobby hosts its table, so that it is only snapshotted and logged once
+    host_default = worker is None or worker_index(args.lobby_id.encode(), args.workers) == worker
+    lobbies = LobbyManager(args.lobby_id, args.multi_lobby, args.max_tables, args.decks, args.penetration,
+                           args.max_queue, store, args.history, host_default)
+    snapshot = args.snapshot
+    if snapshot is not None and worker is not None:
+        snapshot = f'{snapshot}.{worker}'
+    hints = HintCache(args.hint_cache) if args.hint_cache > 0 else None
+    game_server = Server(lobbies, args.max_connections, grace=args.grace, snapshot=snapshot,
+                         snapshot_interval=args.snapshot_interval, hints=hints)
+    # the first hints of a shoe are worked out in the background while the server starts
+    game_server.precompute_hints(args.decks)
+
+    if args.restore:
+        start = time.perf_counter()
+        game_server.restore(load_snapshots(args.snapshot, worker, args.workers))
+        print(f'Restored {len(game_server.restored)} tables in {(time.perf_counter() - start) * 1e3:.1f} ms')
+    return game_server, store
 
 
+def run_worker(pipe, worker, args):
+    """Entry point of a worker process
+
+    Args:
+        pipe (Connection): duplex pipe to the router
+        worker (int): index of the worker
+        args (Namespace): parsed command line arguments of the server
+    """
+    game_server, store = create_server(args, worker)
+    try:
+        asyncio.run(game_server.serve_worker(pipe))
+    finally:
+        if store is not None:
+            store.close()
+
 
 def clear_console():
     command = 'clear'
@@ -126,8 +1349,30 @@ def main():
     parser = argparse.ArgumentParser(description='Change parameters for the server')
     parser.add_argument('-lobby', '--lobby_id', metavar='', type=str, default='', help='Lobby ID for the server')
     parser.add_argument('-port', '--find_open_port', action='store_true', help='Automatically find open ports')
+    parser.add_argument('-multi', '--multi_lobby', action='store_true', help='Open a table for every lobby ID on demand')
+    parser.add_argument('-max_tables', '--max_tables', metavar='', type=int, default=1000, help='Maximum number of tables open at once')
+    parser.add_argument('-max_conn', '--max_connections', metavar='', type=int, default=10000, help='Maximum number of open connections')
+    parser.add_argument('-workers', '--workers', metavar='', type=int, default=0, help='Number of worker processes hosting the tables, 0 to host them in this process')
+    parser.add_argument('-decks', '--decks', metavar='', type=int, default=DEFAULT_DECKS, help='Number of decks in the shoe')
+    parser.add_argument('-penetration', '--penetration', metavar='', type=float, default=DEFAULT_PENETRATION, help='Share of the shoe dealt before it is reshuffled')
+    parser.add_argument('-max_queue', '--max_queue', metavar='', type=int, default=MAX_QUEUE, help='Maximum number of players waiting for a seat at each table')
+    parser.add_argument('-bankroll', '--bankroll', metavar='', type=str, default=None, help='SQLite file the money of the players is kept in across connections')
+    parser.add_argument('-grace', '--grace', metavar='', type=float, default=GRACE_PERIOD, help='Seconds the seat of a dropped connection is held for the player to resume it')
+    parser.add_argument('-history', '--history', metavar='', type=str, default=None, help='Directory the hand history of each table is logged to')
+    parser.add_argument('-snapshot', '--snapshot', metavar='', type=str, default=None, help='File every table is saved to periodically and on shutdown')
+    parser.add_argument('-snapshot_interval', '--snapshot_interval', metavar='', type=float, default=SNAPSHOT_INTERVAL, help='Seconds between the snapshots')
+    parser.add_argument('-restore', '--restore', action='store_true', help='Start with the tables of the last snapshot, the players can resume their seats')
+    parser.add_argument('-hint_cache', '--hint_cache', metavar='', type=int, default=MAX_HINTS, help='Number of hints kept in memory, 0 to turn the Hint command off')
 
     args = parser.parse_args()
+    if args.decks < 1:
+        parser.error('the shoe needs at least one deck')
+    if not 0 < args.penetration <= 1:
+        parser.error('the penetration must be in (0, 1]')
+    if args.history is not None:
+        os.makedirs(args.history, exist_ok=True)
+    if args.restore and args.snapshot is None:
+        parser.error('-restore needs the -snapshot file to restore from')
 
     LOBBY_ID = args.lobby_id
     FIND_OPEN_PORT = args.find_open_port
@@ -143,6 +1388,9 @@ def main():
 
     # create server
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != 'nt':
+        # allow restarting straight after a shutdown
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
         s.bind((server, port))
     except socket.error as e:
@@ -158,22 +1406,53 @@ def main():
         print('No lobby ID set')
     else:
         print(f'Lobby ID: {LOBBY_ID}')
+    if args.multi_lobby:
+        print(f'Tables are opened for any lobby ID (up to {args.max_tables})')
 
     print(f'Server IP: {server_ip}, Server Port: {server_port}')
+    print(f'Shoe: {args.decks} decks, reshuffled after {args.penetration:.0%}')
+    if args.bankroll is not None:
+        print(f'Bankrolls are kept in {args.bankroll}')
+    if args.history is not None:
+        print(f'Hand histories are logged to {args.history}')
+    if args.snapshot is not None:
+        print(f'Tables are saved to {args.snapshot} every {args.snapshot_interval:g} s')
+    if args.hint_cache > 0:
+        print(f'Up to {args.hint_cache} hints are kept in memory')
     
-    game = BlackjackTable()
+    if args.workers > 0:
+        print(f'Tables are shared between {args.workers} worker processes')
     print()
-    
-    count = 0
     print('Logs:')
-    while True:
-        # wait until connection is accepted
-        conn, addr = s.accept()
-        print(f'Connected to: {addr}')
-        count += 1
-
-        # start player
-        start_new_thread(threaded_client, (conn, count, game, LOBBY_ID))
+
+    if args.bankroll is not None:
+        release_seats(args.bankroll)
+
+    if args.workers > 0:
+        # each worker owns the tables of the lobby IDs routed to it
+        context = multiprocessing.get_context('spawn')
+        workers = []
+        try:
+            for worker in range(args.workers):
+                pipe, child_pipe = context.Pipe()
+                # not a daemon, so that the worker can start its hint process, it is stopped below instead
+                process = context.Process(target=run_worker, args=(child_pipe, worker, args))
+                process.start()
+                workers.append((process, pipe))
+            asyncio.run(Router(workers).serve(s))
+        finally:
+            for process, _ in workers:
+                if process.is_alive():
+                    process.terminate()
+    else:
+        game_server, store = create_server(args)
+        try:
+            asyncio.run(game_server.serve(s))
+        finally:
+            # write the last saves before exiting
+            if store is not None:
+                store.close()
+    print('Server shut down')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,320 @@
+import argparse
+import contextlib
+import io
+import time
+from array import array
+
+import numpy as np
+
+from blackjack import (BlackjackTable, Player, Shoe, CARD_VALUES, DECK_SIZE, DEFAULT_MONEY, MAX_PLAYERS,
+                       DEFAULT_DECKS, DEFAULT_PENETRATION)
+
+VALUES = np.array(CARD_VALUES[:DECK_SIZE])     # blackjack value of each card code, aces are 1
+
+
+class Shoes:
+    def __init__(self, rng, tables, decks=DEFAULT_DECKS, penetration=DEFAULT_PENETRATION):
+        """Shoe of every table, dealt like Shoe: the cards are drawn from the end and the shoe is only
+        reshuffled at the start of a round once the cut card has come out
+
+        Args:
+            rng (Generator): random generator
+            tables (int): number of tables
+            decks (int, optional): number of decks in each shoe. Defaults to DEFAULT_DECKS.
+            penetration (float, optional): share of the shoe dealt before the cut card. Defaults to DEFAULT_PENETRATION.
+
+        Raises:
+            ValueError: When there is no deck or the penetration is not in (0, 1]
+        """
+        if decks < 1:
+            raise ValueError('The shoe needs at least one deck')
+        if not 0 < penetration <= 1:
+            raise ValueError('The penetration must be in (0, 1]')
+        self.rng = rng
+        self.size = decks * DECK_SIZE
+        self.cards = np.tile(np.arange(DECK_SIZE, dtype=np.uint8), (tables, decks))    # card codes of each shoe
+        self.cut = self.size - max(1, int(self.size * penetration))   # cards left when the cut card comes out
+        self.remaining = np.full(tables, self.size)     # number of cards not drawn yet at each table
+        self.round_start = self.remaining.copy()        # remaining at the start of the round
+        self.ran_out = np.zeros(tables, dtype=bool)     # tables that ran out of cards during the round
+        self.shuffle(np.ones(tables, dtype=bool))
+
+    def shuffle(self, tables):
+        """Puts all the cards back and shuffles the shoes of some tables
+
+        Args:
+            tables (ndarray): mask of the tables to shuffle
+        """
+        self.cards[tables] = self.rng.permuted(self.cards[tables], axis=1)
+        self.remaining[tables] = self.size
+
+    def start_round(self):
+        """Reshuffles the shoes the cut card came out of during the last round
+        """
+        self.shuffle(self.remaining <= self.cut)
+        self.round_start[:] = self.remaining
+        self.ran_out[:] = False
+
+    def draw(self, tables):
+        """Draws a card at some tables. A shoe that runs out in the middle of a round has its
+        discarded cards shuffled back in, as in Shoe.draw_card, which is rare enough to be done
+        one table at a time
+
+        Args:
+            tables (ndarray): mask of the tables drawing a card
+
+        Returns:
+            ndarray: blackjack value of the card drawn at each of the tables
+        """
+        for table in np.flatnonzero(tables & (self.remaining == 0)):
+            start = self.round_start[table]
+            discards = self.size - start
+            assert discards != 0, 'Shoe is empty'
+            cards = np.concatenate((self.cards[table, start:], self.cards[table, :start]))
+            cards[:discards] = self.rng.permutation(cards[:discards])
+            self.cards[table] = cards
+            self.remaining[table] = discards
+            self.round_start[table] = self.size
+            self.ran_out[table] = True
+        self.remaining[tables] -= 1
+        return VALUES[self.cards[tables, self.remaining[tables]]]
+
+    def shoe(self, table):
+        """Shoe of a table as a Shoe, to deal the same cards with BlackjackTable
+
+        Args:
+            table (int): index of the table
+
+        Returns:
+            Shoe: copy of the shoe in its current state
+        """
+        return Shoe.from_state(array('B', self.cards[table].tobytes()), self.cut,
+                               int(self.remaining[table]), int(self.round_start[table]))
+
+
+def hand_total(hard, aces):
+    """Vectorized Player.get_card_total
+
+    Args:
+        hard (ndarray): totals counting aces as 1
+        aces (ndarray): number of aces in each hand
+
+    Returns:
+        ndarray: totals with an ace counted as 11 where that does not bust
+    """
+    return np.where((aces > 0) & (hard + 10 <= 21), hard + 10, hard)
+
+
+def play_round(shoes, players, stand_on=17):
+    """Plays one round at every table with the rules of BlackjackTable
+
+    Every table deals from its shoe and every player hits until their total reaches stand_on. The
+    deal, the dealer drawing to 17 and the settlement follow deal_cards_init, next_turn and
+    dealers_turn.
+
+    Args:
+        shoes (Shoes): shoe of every table
+        players (int): number of players at each table
+        stand_on (int, optional): total the players stand on. Defaults to 17.
+
+    Returns:
+        ndarray: (tables, players) has_won of every player, 0 lost, 1 tie, 2 won
+    """
+    shoes.start_round()
+    every = np.ones(len(shoes.remaining), dtype=bool)
+
+    # dealer gets 2 cards, then each player gets 2 cards
+    first, second = shoes.draw(every), shoes.draw(every)
+    dealer_hard = first + second
+    dealer_aces = (first == 1).astype(int) + (second == 1)
+    cards = np.stack([shoes.draw(every) for _ in range(2*players)], axis=1)
+    hard = cards[:, 0::2] + cards[:, 1::2]
+    aces = (cards[:, 0::2] == 1).astype(int) + (cards[:, 1::2] == 1)
+
+    blackjack_dealer = hand_total(dealer_hard, dealer_aces) == 21
+    blackjack_player = hand_total(hard, aces) == 21
+
+    # players take their turn one after the other, players that blackjacked are skipped
+    for p in range(players):
+        hitting = ~blackjack_dealer & ~blackjack_player[:, p] & (hand_total(hard[:, p], aces[:, p]) < stand_on)
+        while hitting.any():
+            card = shoes.draw(hitting)
+            hard[hitting, p] += card
+            aces[hitting, p] += card == 1
+            hitting &= hand_total(hard[:, p], aces[:, p]) < stand_on
+
+    # dealer draws to 17
+    drawing = ~blackjack_dealer & (hand_total(dealer_hard, dealer_aces) < 17)
+    while drawing.any():
+        card = shoes.draw(drawing)
+        dealer_hard[drawing] += card
+        dealer_aces[drawing] += card == 1
+        drawing &= hand_total(dealer_hard, dealer_aces) < 17
+
+    # settle the bets
+    total_dealer = hand_total(dealer_hard, dealer_aces)[:, None]
+    total_player = hand_total(hard, aces)
+    busted = total_player > 21
+    lost = busted | ((total_player < total_dealer) & (total_dealer <= 21))
+    tied = ~lost & (total_player == total_dealer)
+    has_won = np.where(lost, 0, np.where(tied, 1, 2))
+
+    # if the dealer blackjacks, players that blackjacked tie and everyone else loses
+    has_won[blackjack_dealer] = np.where(blackjack_player[blackjack_dealer], 1, 0)
+    return has_won
+
+
+def simulate(tables, rounds, players, bet=1, stand_on=17, money=DEFAULT_MONEY, seed=0,
+             decks=DEFAULT_DECKS, penetration=DEFAULT_PENETRATION):
+    """Plays many rounds at many independent tables
+
+    Args:
+        tables (int): number of tables played in parallel
+        rounds (int): number of rounds played at each table
+        players (int): number of players at each table
+        bet (int, optional): bet placed by every player each round. Defaults to 1.
+        stand_on (int, optional): total the players stand on. Defaults to 17.
+        money (int, optional): starting money of every player. Defaults to DEFAULT_MONEY.
+        seed (int, optional): seed of the random generator. Defaults to 0.
+        decks (int, optional): number of decks in the shoe of each table. Defaults to DEFAULT_DECKS.
+        penetration (float, optional): share of the shoe dealt before reshuffling. Defaults to DEFAULT_PENETRATION.
+
+    Returns:
+        dict: outcome rates, house edge and standard deviation per hand in bets, risk of ruin and hands per second
+    """
+    shoes = Shoes(np.random.default_rng(seed), tables, decks, penetration)
+    bankroll = np.full((tables, players), money)
+    ruined = np.zeros((tables, players), dtype=bool)
+    counts = np.zeros(3, dtype=np.int64)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        has_won = play_round(shoes, players, stand_on)
+        result = (has_won - 1) * bet
+        bankroll += result
+        ruined |= bankroll < bet
+        counts += np.bincount(has_won.ravel(), minlength=3)
+    elapsed = time.perf_counter() - start
+
+    # each hand loses, returns or wins one bet
+    hands = counts.sum()
+    lost, tied, won = counts / hands
+    return {
+        'hands': int(hands),
+        'lost': lost,
+        'tied': tied,
+        'won': won,
+        'house_edge': lost - won,
+        'stdev': np.sqrt(lost + won - (won - lost)**2),
+        'ruin': float(ruined.mean()),
+        'final_money': float(bankroll.mean()),
+        'hands_per_second': hands / elapsed,
+    }
+
+
+def play_object_round(game, stand_on=17, bet=1):
+    """Plays one round with BlackjackTable, then clears the table for the next one
+
+    Args:
+        game (BlackjackTable): table with its players seated
+        stand_on (int, optional): total the players stand on. Defaults to 17.
+        bet (int, optional): bet placed by every player. Defaults to 1.
+
+    Returns:
+        list: has_won of every player
+    """
+    keys = list(game.players.keys())
+    for key in keys:
+        # the players never run out of money, so that they always bet
+        game.players[key].money = DEFAULT_MONEY
+        game.player_ready(key)
+    for key in keys:
+        for _ in range(bet):
+            game.add_bet(key)
+        game.confirm_bet(key)
+
+    while game.scene == 2:
+        key = keys[game.current_turn_idx]
+        if game.players[key].get_card_total() < stand_on:
+            game.hit(key)
+        else:
+            game.stand(key)
+    has_won = [game.players[key].has_won for key in keys]
+    game.new_round()
+    return has_won
+
+
+def check_parity(rounds, players, stand_on=17, seed=0, decks=DEFAULT_DECKS, penetration=DEFAULT_PENETRATION):
+    """Checks that play_round gives the same results as BlackjackTable, dealing the same shoe. Before
+    every round, the table is given a copy of the shoe as play_round has left it
+
+    Args:
+        rounds (int): number of rounds to compare
+        players (int): number of players at the table
+        stand_on (int, optional): total the players stand on. Defaults to 17.
+        seed (int, optional): seed of the random generator. Defaults to 0.
+        decks (int, optional): number of decks in the shoe. Defaults to DEFAULT_DECKS.
+        penetration (float, optional): share of the shoe dealt before reshuffling. Defaults to DEFAULT_PENETRATION.
+
+    Returns:
+        tuple: (rounds where the results differ, rounds not compared because the shoe ran out during
+        them, which reshuffles the discards with another random generator)
+    """
+    shoes = Shoes(np.random.default_rng(seed), 1, decks, penetration)
+    game = BlackjackTable(decks, penetration)
+    for i in range(players):
+        game.join(Player(f'Player {i}'))
+    mismatches = skipped = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(rounds):
+            shoes.start_round()
+            game.shoe = shoes.shoe(0)
+            has_won = play_round(shoes, players, stand_on)[0].tolist()
+            if shoes.ran_out[0]:
+                skipped += 1
+                game.new_round()
+            elif play_object_round(game, stand_on) != has_won:
+                mismatches += 1
+    return mismatches, skipped
+
+
+def main():
+    # argparse
+    parser = argparse.ArgumentParser(description='Monte Carlo simulation of the table rules')
+    parser.add_argument('-tables', '--tables', metavar='', type=int, default=10000, help='Number of tables played in parallel')
+    parser.add_argument('-rounds', '--rounds', metavar='', type=int, default=100, help='Number of rounds played at each table')
+    parser.add_argument('-players', '--players', metavar='', type=int, default=MAX_PLAYERS, help='Number of players at each table')
+    parser.add_argument('-bet', '--bet', metavar='', type=int, default=1, help='Bet placed by every player each round')
+    parser.add_argument('-stand', '--stand_on', metavar='', type=int, default=17, help='Total the players stand on')
+    parser.add_argument('-money', '--money', metavar='', type=int, default=DEFAULT_MONEY, help='Starting money of every player')
+    parser.add_argument('-seed', '--seed', metavar='', type=int, default=0, help='Seed of the random generator')
+    parser.add_argument('-decks', '--decks', metavar='', type=int, default=DEFAULT_DECKS, help='Number of decks in the shoe of each table')
+    parser.add_argument('-penetration', '--penetration', metavar='', type=float, default=DEFAULT_PENETRATION, help='Share of the shoe dealt before it is reshuffled')
+    parser.add_argument('-check', '--check', metavar='', type=int, default=0, help='Compare this many rounds against BlackjackTable instead')
+
+    args = parser.parse_args()
+    if args.decks < 1:
+        parser.error('the shoe needs at least one deck')
+    if not 0 < args.penetration <= 1:
+        parser.error('the penetration must be in (0, 1]')
+
+    if args.check:
+        mismatches, skipped = check_parity(args.check, args.players, args.stand_on, args.seed, args.decks, args.penetration)
+        print(f'{mismatches} of {args.check - skipped} rounds differ from BlackjackTable')
+        if skipped:
+            print(f'{skipped} rounds ran out of cards and were not compared')
+        return
+
+    stats = simulate(args.tables, args.rounds, args.players, args.bet, args.stand_on, args.money, args.seed,
+                     args.decks, args.penetration)
+    print(f'Hands played:   {stats["hands"]}')
+    print(f'Lost/Tied/Won:  {stats["lost"]:.4f} / {stats["tied"]:.4f} / {stats["won"]:.4f}')
+    print(f'House edge:     {stats["house_edge"]:.4%} of the bet')
+    print(f'Std deviation:  {stats["stdev"]:.4f} bets per hand')
+    print(f'Risk of ruin:   {stats["ruin"]:.4%} of players starting with ${args.money} over {args.rounds} rounds')
+    print(f'Average money:  ${stats["final_money"]:.2f} after {args.rounds} rounds')
+    print(f'Speed:          {stats["hands_per_second"]:.0f} hands per second')
+
+
+if __name__ == '__main__':
+    main()
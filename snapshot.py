@@ -0,0 +1,179 @@
+import os
+import struct
+import threading
+import zlib
+from array import array
+
+from blackjack import BlackjackTable, Player, Shoe, Hand
+from codec import NO_TURN, NO_RESULT, encode_name
+
+# Binary snapshot of every table, laid out so that a table loads with a few struct calls and the
+# card codes load straight into arrays.
+#
+#   header      magic, u32 version, u32 number of tables
+#   per table
+#     table     u16 lobby ID length, u8 scene, u8 turn (NO_TURN for None), u8 dealer hidden,
+#               u8 dealer cards, u8 players, u32 shoe size, u32 cut, u32 remaining, u32 round start
+#     lobby ID  utf-8 bytes
+#     dealer    u8 card code per card
+#     shoe      u8 card code per card
+#     per player, in seat order
+#       seat    u8 seat, u8 name length, u8 flags, u8 cards, i64 money, i64 bet
+#       name    utf-8 bytes
+#       cards   u8 card code per card
+#       token   16 bytes, the resume token of the seat, zeros if it has none
+#   checksum    u32 crc32 of everything before it
+#
+# Flags are is_ready | has_busted << 1 | has_won << 2 with NO_RESULT for None, as in codec.py
+MAGIC = b'BJSNAP\0\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII')
+TABLE = struct.Struct('<HBBBBBIIII')
+SEAT = struct.Struct('<BBBBqq')
+CHECKSUM = struct.Struct('<I')
+TOKEN_SIZE = 16
+NO_TOKEN = bytes(TOKEN_SIZE)
+
+# snapshots can be written from several threads, the last one written wins
+write_lock = threading.Lock()
+
+
+def encode_tables(tables):
+    """Encodes every table into the snapshot format
+
+    Args:
+        tables (list): (lobby ID, BlackjackTable, dict of player ID -> resume token in hex) of every table
+
+    Returns:
+        bytes: the snapshot
+    """
+    data = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, len(tables)))
+    for lobby_id, game, tokens in tables:
+        lobby = lobby_id.encode()
+        shoe = game.shoe
+        dealer = game.dealer.cards.cards
+        turn = NO_TURN if game.current_turn_idx is None else game.current_turn_idx
+        data += TABLE.pack(len(lobby), game.scene, turn, game.dealer.hidden, len(dealer), len(game.players),
+                           len(shoe.cards), shoe.cut, shoe.remaining, shoe.round_start)
+        data += lobby
+        data += dealer
+        data += shoe.cards
+        for key, player in game.players.items():
+            name = encode_name(player.name)
+            has_won = NO_RESULT if player.has_won is None else player.has_won
+            flags = int(player.is_ready) | int(player.has_busted) << 1 | has_won << 2
+            cards = player.cards.cards
+            data += SEAT.pack(int(key), len(name), flags, len(cards), player.money, player.bet)
+            data += name
+            data += cards
+            token = tokens.get(int(key))
+            data += NO_TOKEN if token is None else bytes.fromhex(token)
+    data += CHECKSUM.pack(zlib.crc32(data))
+    return bytes(data)
+
+
+def decode_tables(data):
+    """Decodes a snapshot made by encode_tables
+
+    Args:
+        data (bytes): the snapshot
+
+    Raises:
+        ValueError: When the data is not a snapshot, is damaged or is in an unsupported version of the format
+
+    Returns:
+        list: (lobby ID, BlackjackTable, dict of player ID -> resume token in hex) of every table
+    """
+    try:
+        magic, version, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Not a table snapshot')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot format version {version}')
+        (checksum,) = CHECKSUM.unpack_from(data, len(data) - CHECKSUM.size)
+        if zlib.crc32(memoryview(data)[:-CHECKSUM.size]) != checksum:
+            raise ValueError('Damaged table snapshot')
+
+        pos = HEADER.size
+        tables = []
+        for _ in range(count):
+            (lobby_size, scene, turn, hidden, dealer_size, players, shoe_size, cut, remaining,
+             round_start) = TABLE.unpack_from(data, pos)
+            pos += TABLE.size
+            lobby_id = data[pos:pos+lobby_size].decode()
+            pos += lobby_size
+            dealer = data[pos:pos+dealer_size]
+            pos += dealer_size
+            shoe = Shoe.from_state(array('B', data[pos:pos+shoe_size]), cut, remaining, round_start)
+            pos += shoe_size
+
+            game = BlackjackTable(shoe=shoe)
+            game.scene = scene
+            game.current_turn_idx = None if turn == NO_TURN else turn
+            game.dealer.cards = Hand(dealer)
+            game.dealer.hidden = bool(hidden)
+            tokens = {}
+            for _ in range(players):
+                seat, name_size, flags, cards_size, money, bet = SEAT.unpack_from(data, pos)
+                pos += SEAT.size
+                player = Player(data[pos:pos+name_size].decode(errors='replace'), money)
+                pos += name_size
+                player.cards = Hand(data[pos:pos+cards_size])
+                pos += cards_size
+                token = data[pos:pos+TOKEN_SIZE]
+                pos += TOKEN_SIZE
+
+                player.bet = bet
+                player.is_ready = bool(flags & 1)
+                player.has_busted = bool(flags & 2)
+                has_won = flags >> 2 & 3
+                player.has_won = None if has_won == NO_RESULT else has_won
+                game.players[str(seat)] = player
+                if token != NO_TOKEN:
+                    tokens[seat] = token.hex()
+            tables.append((lobby_id, game, tokens))
+        if pos != len(data) - CHECKSUM.size:
+            raise ValueError('Damaged table snapshot')
+        return tables
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError('Damaged table snapshot') from e
+
+
+def write_snapshot(path, data):
+    """Replaces a snapshot file atomically, a crash leaves either the old or the new snapshot
+
+    Args:
+        path (str): path of the snapshot
+        data (bytes): snapshot made by encode_tables
+    """
+    with write_lock:
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+
+        # make the rename itself durable
+        if os.name != 'nt':
+            directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+
+def read_snapshot(path):
+    """Reads a snapshot file
+
+    Args:
+        path (str): path of the snapshot
+
+    Raises:
+        ValueError: When the file is not a snapshot or is damaged
+
+    Returns:
+        list: tables returned by decode_tables
+    """
+    with open(path, 'rb') as f:
+        return decode_tables(f.read())
@@ -0,0 +1,388 @@
+import threading
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+
+from blackjack import CARD_VALUES, DECK_SIZE, DEFAULT_DECKS
+
+# Exact expected values of hitting and standing, from the cards that have not been seen yet.
+#
+# A composition is a tuple of 10 counts, the number of unseen cards of each value from ace to ten.
+# The dealer's hole card is unseen too, and the players only play when the dealer did not blackjack,
+# so every probability below is the probability of the outcome AND of the hole card not making a
+# blackjack. Standing and hitting a hand share that factor, so they compare the same way as the
+# expected values, which are obtained by dividing by it.
+#
+# Payouts follow dealers_turn: a win pays the bet twice, a tie gives it back and a loss takes it, so
+# the expected value per unit bet is P(win) - P(loss). The dealer stands on every 17.
+MAX_HINTS = 1 << 16             # hints kept by a HintCache, the least recently used is evicted
+DEALER_CACHE_SIZE = 1 << 14     # dealer distributions memoized while computing hints
+HAND_CACHE_SIZE = 1 << 16       # hand values memoized while computing hints
+OUTCOMES = 6                    # the dealer ends on 17, 18, 19, 20, 21 or busts
+BUST = 5
+
+# card code -> index of its value in a composition, so that a shoe is counted by bytes.translate
+VALUE_INDEX = bytes(CARD_VALUES[code] - 1 for code in range(DECK_SIZE)) + bytes(256 - DECK_SIZE)
+
+
+def composition(cards):
+    """Counts the cards of each value
+
+    Args:
+        cards (bytes or array): card codes
+
+    Returns:
+        tuple: number of cards of each value, aces first
+    """
+    values = bytes(cards).translate(VALUE_INDEX)
+    return tuple(values.count(i) for i in range(10))
+
+
+def full_shoe(decks=DEFAULT_DECKS):
+    """Composition of a whole shoe
+
+    Args:
+        decks (int, optional): number of decks. Defaults to DEFAULT_DECKS.
+
+    Returns:
+        tuple: number of cards of each value, aces first
+    """
+    return (4*decks,) * 9 + (16*decks,)
+
+
+def remove(comp, value):
+    """Composition with a card of the given value taken out
+    """
+    i = value - 1
+    return comp[:i] + (comp[i] - 1,) + comp[i+1:]
+
+
+def soft_total(hard, aces):
+    """Total of a hand, an ace counts as 11 if that does not bust the hand, as in Hand.total
+    """
+    return hard + 10 if aces and hard <= 11 else hard
+
+
+@lru_cache(maxsize=None)
+def dealer_terms(upcard):
+    """Every set of cards the dealer can end up drawing behind an upcard, hole card included
+
+    The chance of drawing a given sequence of cards only depends on how many cards of each value
+    it has, so the sequences are grouped by those counts and by the total they end on, and the
+    distribution of the dealer for any composition is a sum over the groups
+
+    Args:
+        upcard (int): value of the dealer's face up card
+
+    Returns:
+        tuple: (terms, most cards drawn + 1). Each term is (cards drawn, number of orders they can be
+        drawn in, outcome index, indexes of the counts into the table built by dealer_outcomes)
+    """
+    groups = defaultdict(int)
+    counts = [0] * 10
+
+    def draw(hard, aces, hole):
+        total = soft_total(hard, aces)
+        if not hole and total >= 17:
+            groups[tuple(counts), min(total, 22) - 17] += 1
+            return
+        for value in range(1, 11):
+            # an ace and a ten would have been a blackjack, which ends the round before the players play
+            if hole and upcard + value == 11 and 1 in (upcard, value):
+                continue
+            counts[value - 1] += 1
+            draw(hard + value, aces or value == 1, False)
+            counts[value - 1] -= 1
+
+    draw(upcard, upcard == 1, True)
+    depth = max(sum(group) for group, _ in groups) + 1
+    terms = tuple((sum(group), orders, outcome, tuple(i*depth + n for i, n in enumerate(group) if n))
+                  for (group, outcome), orders in groups.items())
+    return terms, depth
+
+
+@lru_cache(maxsize=DEALER_CACHE_SIZE)
+def dealer_outcomes(upcard, comp):
+    """Distribution of the dealer's final total
+
+    Args:
+        upcard (int): value of the dealer's face up card
+        comp (tuple): composition the hole card and the dealer's cards are drawn from
+
+    Returns:
+        tuple: probability of ending on 17, 18, 19, 20, 21 and of busting, each together with the
+        dealer not having a blackjack
+    """
+    terms, depth = dealer_terms(upcard)
+
+    # falling[i*depth + n] is the number of ways to draw n cards in order from the cards of value i+1
+    falling = []
+    for count in comp:
+        ways = 1.0
+        falling.append(ways)
+        for n in range(1, depth):
+            ways *= count - n + 1
+            falling.append(ways)
+    cards = sum(comp)
+    inverse = [1.0]
+    ways = 1.0
+    for n in range(1, depth):
+        ways *= cards - n + 1
+        inverse.append(1 / ways if ways > 0 else 0.0)
+
+    result = [0.0] * OUTCOMES
+    for drawn, orders, outcome, indexes in terms:
+        p = orders * inverse[drawn]
+        for i in indexes:
+            p *= falling[i]
+        result[outcome] += p
+    return tuple(result)
+
+
+def no_blackjack(upcard, comp, cards):
+    """Probability of the hole card not making a blackjack
+
+    Args:
+        upcard (int): value of the dealer's face up card
+        comp (tuple): composition the hole card is drawn from
+        cards (int): number of cards in the composition
+
+    Returns:
+        float: probability
+    """
+    # the hole card is one of the unseen cards, so drawing them all cannot happen
+    if cards == 0:
+        return 0.0
+    if upcard == 1:
+        return 1 - comp[9] / cards
+    if upcard == 10:
+        return 1 - comp[0] / cards
+    return 1.0
+
+
+def stand_value(total, upcard, comp):
+    """Expected value of standing, together with the dealer not having a blackjack
+
+    Args:
+        total (int): total of the player
+        upcard (int): value of the dealer's face up card
+        comp (tuple): unseen cards
+
+    Returns:
+        float: P(win) - P(loss)
+    """
+    outcomes = dealer_outcomes(upcard, comp)
+    value = outcomes[BUST]
+    for dealer_total, p in enumerate(outcomes[:BUST], 17):
+        if total > dealer_total:
+            value += p
+        elif total < dealer_total:
+            value -= p
+    return value
+
+
+@lru_cache(maxsize=HAND_CACHE_SIZE)
+def hand_values(hard, aces, upcard, comp):
+    """Expected values of standing and of hitting a hand then playing on perfectly, together with the
+    dealer not having a blackjack
+
+    Standing is only worked out when it can be the better choice. A hand that cannot bust on the
+    next card and stands on 16 or less only wins if the dealer busts, which is just as likely after
+    any card is drawn, so hitting it and standing is never worse
+
+    Args:
+        hard (int): total of the player counting aces as 1
+        aces (bool): if the player holds an ace
+        upcard (int): value of the dealer's face up card
+        comp (tuple): unseen cards
+
+    Returns:
+        tuple: (stand, hit), -inf for a choice that is never the better one
+    """
+    total = soft_total(hard, aces)
+    if total >= 21:
+        return stand_value(total, upcard, comp), float('-inf')
+
+    hit = 0.0
+    cards = sum(comp)
+    for value, count in enumerate(comp, 1):
+        if count:
+            p = count / cards
+            after = remove(comp, value)
+            if hard + value > 21:
+                # a busted hand loses whatever the dealer has
+                hit -= p * no_blackjack(upcard, after, cards - 1)
+            else:
+                hit += p * max(hand_values(hard + value, aces or value == 1, upcard, after))
+    stand = stand_value(total, upcard, comp) if total > 16 or hard > 11 else float('-inf')
+    return stand, hit
+
+
+def expected_values(hard, aces, upcard, comp):
+    """Expected values of standing and hitting a hand, exact as long as the shoe does not run out
+    during the round, which the cut card prevents
+
+    Args:
+        hard (int): total of the player counting aces as 1
+        aces (bool): if the player holds an ace
+        upcard (int): value of the dealer's face up card
+        comp (tuple): cards the player has not seen, the dealer's hole card included
+
+    Returns:
+        tuple: (stand, hit) expected value per unit bet, given that the dealer did not blackjack
+    """
+    scale = no_blackjack(upcard, comp, sum(comp))
+    stand = stand_value(soft_total(hard, aces), upcard, comp) / scale
+    hit = hand_values(hard, aces, upcard, comp)[1] / scale
+    return stand, hit
+
+
+def opening_keys(decks=DEFAULT_DECKS, upcards=range(1, 11)):
+    """Situations of every first two cards against the given upcards, dealt from a whole shoe
+
+    Args:
+        decks (int, optional): number of decks in the shoe. Defaults to DEFAULT_DECKS.
+        upcards (iterable, optional): values of the dealer's face up card. Defaults to every value.
+
+    Returns:
+        list: situations as returned by hand_key
+    """
+    keys = []
+    for upcard in upcards:
+        shoe = remove(full_shoe(decks), upcard)
+        for first in range(1, 11):
+            for second in range(first, 11):
+                if first == 1 and second == 10:
+                    continue
+                keys.append((first + second, first == 1, upcard, remove(remove(shoe, first), second)))
+    return keys
+
+
+def opening_hints(decks=DEFAULT_DECKS, upcard=1):
+    """Works out the hints of the first two cards against an upcard, which also builds the dealer
+    tables the other hints of the process need for that upcard. Takes about half a second
+
+    Args:
+        decks (int, optional): number of decks in the shoe. Defaults to DEFAULT_DECKS.
+        upcard (int, optional): value of the dealer's face up card. Defaults to 1.
+
+    Returns:
+        dict: situation -> (stand, hit)
+    """
+    return {key: expected_values(*key) for key in opening_keys(decks, (upcard,))}
+
+
+def hand_key(game, player_id):
+    """Situation of a player for a hint, as seen from their seat
+
+    Args:
+        game (BlackjackTable): table
+        player_id (int): player ID
+
+    Returns:
+        tuple: (hard total, holds an ace, dealer's upcard, unseen cards), None if the player has no
+        choice to make
+    """
+    player = game.players.get(str(player_id))
+    if game.scene != 2 or player is None or len(game.dealer.cards) < 2:
+        return None
+    hand = player.cards
+    if not hand.cards or hand.total() >= 21:
+        return None
+
+    # the unseen cards are the ones left in the shoe and the hole card
+    shoe = game.shoe
+    comp = composition(shoe.cards[:shoe.remaining] + game.dealer.cards.cards[1:2])
+    upcard = CARD_VALUES[game.dealer.cards[0]]
+    return hand.hard_total, hand.aces > 0, upcard, comp
+
+
+class HintCache:
+    def __init__(self, max_hints=MAX_HINTS):
+        """Expected values of the hands already worked out, so that asking again is a dictionary
+        lookup. Safe to use from several threads
+
+        Args:
+            max_hints (int, optional): number of hints kept, the least recently used is evicted. Defaults to MAX_HINTS.
+        """
+        self.max_hints = max_hints
+        self.hints = OrderedDict()  # hand_key -> (stand, hit), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Looks up a hint without working it out
+
+        Args:
+            key (tuple): situation returned by hand_key
+
+        Returns:
+            tuple: (stand, hit), None if it has not been worked out yet
+        """
+        with self.lock:
+            hint = self.hints.get(key)
+            if hint is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.hints.move_to_end(key)
+            return hint
+
+    def compute(self, key):
+        """Works out a hint and keeps it. Takes from under a millisecond to a few hundred
+        milliseconds of pure Python, so the server works hints out in another process with
+        expected_values and keeps them with put
+
+        Args:
+            key (tuple): situation returned by hand_key
+
+        Returns:
+            tuple: (stand, hit)
+        """
+        hint = expected_values(*key)
+        self.put(key, hint)
+        return hint
+
+    def put(self, key, hint):
+        """Keeps a hint worked out elsewhere
+
+        Args:
+            key (tuple): situation returned by hand_key
+            hint (tuple): (stand, hit)
+        """
+        with self.lock:
+            self.hints[key] = hint
+            self.hints.move_to_end(key)
+            if len(self.hints) > self.max_hints:
+                self.hints.popitem(last=False)
+
+    def precompute(self, decks=DEFAULT_DECKS):
+        """Works out the hints of every first two cards against every upcard from a whole shoe, which
+        also builds the dealer tables every other hint needs
+
+        Args:
+            decks (int, optional): number of decks in the shoe. Defaults to DEFAULT_DECKS.
+
+        Returns:
+            int: number of hints worked out
+        """
+        count = 0
+        for key in opening_keys(decks):
+            with self.lock:
+                known = key in self.hints
+            if not known:
+                self.compute(key)
+                count += 1
+        return count
+
+    def stats(self):
+        """Hit rate of the cache for the admin console
+
+        Returns:
+            str: hits, misses and size
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            rate = self.hits / lookups if lookups else 0.0
+            return (f'{self.hits} cached, {self.misses} worked out ({rate:.1%} hit rate), '
+                    f'{len(self.hints)}/{self.max_hints} kept')